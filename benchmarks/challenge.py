@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark ChallengeEngine against Bticino.answerChallenge().
+
+Run from the repository root:
+    python benchmarks/challenge.py [--pairs 100000] [--nonces 1000]
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bticino  # noqa: E402
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--pairs', type=int, default=100000)
+    parser.add_argument('--nonces', type=int, default=1000,
+                        help='distinct nonces among the pairs')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rnd = random.Random(args.seed)
+    nonces = ['%09d' % rnd.randrange(10 ** 9) for _ in range(args.nonces)]
+    passwords = [rnd.getrandbits(32) for _ in range(args.pairs)]
+    pairs = [rnd.choice(nonces) for _ in range(args.pairs)]
+
+    reference = bticino.Bticino.answerChallenge
+    t_ref, expected = timed(
+        lambda: [int(reference(None, '*#' + n, p)) for (p, n) in zip(passwords, pairs)])
+
+    engine = bticino.ChallengeEngine()
+    t_cold, _ = timed(
+        lambda: [engine.compile(n)(p) for (p, n) in zip(passwords, pairs)])
+    t_warm, compiled = timed(
+        lambda: [engine.compile(n)(p) for (p, n) in zip(passwords, pairs)])
+    t_batch, batch = timed(engine.batch, passwords, pairs)
+
+    if compiled != expected or [int(x) for x in batch] != expected:
+        sys.exit('engine results differ from answerChallenge()')
+
+    print('pairs=%d nonces=%d numpy=%s' % (
+        args.pairs, args.nonces, 'yes' if bticino.numpy else 'no'))
+    for name, seconds in (('answerChallenge', t_ref),
+                          ('compiled (cold cache)', t_cold),
+                          ('compiled (warm cache)', t_warm),
+                          ('batch', t_batch)):
+        print('%-22s %8.3fs %12.0f pairs/s %6.1fx' % (
+            name, seconds, args.pairs / seconds, t_ref / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark suite of the bticino.py client hot paths against bticino_sim.
+
+Measures connect+handshake latency (numeric and HMAC schemes), command
+round-trip latency (sequential and pipelined), monitor frame throughput
+and client CPU per frame, plus the offline FrameDecoder/parseFrame rate.
+The simulator runs on its own event loop thread, so the CPU figures are
+those of the client thread only. Results are printed as JSON.
+
+Run from the repository root:
+    python benchmarks/client.py [--rounds 200] [--frames 50000] [--output run.json]
+    python benchmarks/client.py --baseline run.json --tolerance 0.2
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bticino  # noqa: E402
+import bticino_sim  # noqa: E402
+
+PASSWORD = 12345
+EVENTS = [b'*8*1#1#4#21*16##', b'*8*19*20##', b'*8*20*20##',
+          b'*7*73#1#100*##', b'*7*73#1#10*##']
+
+
+def summary(samples):
+    """Latency percentiles in milliseconds."""
+    ordered = sorted(samples)
+    pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {
+        'n': len(ordered),
+        'mean_ms': 1e3 * sum(ordered) / len(ordered),
+        'p50_ms': 1e3 * pick(0.50),
+        'p90_ms': 1e3 * pick(0.90),
+        'p99_ms': 1e3 * pick(0.99),
+        'max_ms': 1e3 * ordered[-1],
+    }
+
+
+class SimThread():
+    """GatewaySimulator on a private event loop thread."""
+
+    def __init__(self, **kwargs):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.sim = bticino_sim.GatewaySimulator(port=0, rawPort=None, **kwargs)
+        self.call(self.sim.start())
+
+    def call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def spawn(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def close(self):
+        self.call(self.sim.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+async def bench_handshake(port, rounds):
+    samples = []
+    for _ in range(rounds):
+        session = bticino.Bticino(bticino.COMMANDS, '127.0.0.1', port, PASSWORD)
+        start = time.perf_counter()
+        await session.start()
+        samples.append(time.perf_counter() - start)
+        await session.close()
+    return summary(samples)
+
+
+async def bench_rtt(port, rounds, window):
+    session = bticino.Bticino(bticino.COMMANDS, '127.0.0.1', port, PASSWORD)
+    session.window = window
+    await session.start()
+    session.listen()
+    try:
+        samples = []
+        for i in range(rounds):
+            frame = '*8*19*20##' if i % 2 else '*#1013**2##'
+            start = time.perf_counter()
+            await session.request(frame)
+            samples.append(time.perf_counter() - start)
+        result = {'sequential': summary(samples)}
+
+        frames = ['*8*19*20##', '*8*20*20##'] * (rounds // 2)
+        start = time.perf_counter()
+        replies = await session.pipeline(frames)
+        elapsed = time.perf_counter() - start
+        result['pipelined'] = {
+            'window': window,
+            'commands': len(replies),
+            'commands_per_s': len(replies) / elapsed,
+        }
+        return result
+    finally:
+        await session.close()
+
+
+async def bench_monitor(sim, frames, burst):
+    monitor = bticino.Bticino(bticino.MONITOR, '127.0.0.1', sim.sim.port, PASSWORD)
+    done = asyncio.Event()
+    received = [0]
+
+    def count(frame):
+        received[0] += 1
+        if received[0] >= frames:
+            done.set()
+
+    monitor.addListener(count)
+    task = asyncio.ensure_future(monitor.run())
+    while not sim.sim.monitors:
+        await asyncio.sleep(0.01)
+    cpu = time.thread_time()
+    start = time.perf_counter()
+    sim.spawn(sim.sim.generate(EVENTS, rate=1e6, count=frames, burst=burst))
+    await asyncio.wait_for(done.wait(), 60)
+    elapsed = time.perf_counter() - start
+    cpu = time.thread_time() - cpu
+    monitor.stop()
+    await task
+    return {
+        'frames': received[0],
+        'frames_per_s': received[0] / elapsed,
+        'cpu_us_per_frame': 1e6 * cpu / received[0],
+    }
+
+
+def bench_decode(frames, chunk=bticino.READ_SIZE):
+    stream = b''.join(EVENTS) * (frames // len(EVENTS))
+    chunks = [stream[i:i + chunk] for i in range(0, len(stream), chunk)]
+    decoder = bticino.FrameDecoder()
+    cpu = time.process_time()
+    start = time.perf_counter()
+    decoded = 0
+    for data in chunks:
+        for frame in decoder.feed(data):
+            bticino.parseFrame(frame)
+            decoded += 1
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    return {
+        'frames': decoded,
+        'frames_per_s': decoded / elapsed,
+        'cpu_us_per_frame': 1e6 * cpu / decoded,
+    }
+
+
+def run(args):
+    results = {
+        'label': args.label,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'params': vars(args),
+        'handshake': {},
+    }
+    for auth in (bticino_sim.AUTH_NUMERIC, bticino_sim.AUTH_HMAC):
+        sim = SimThread(password=PASSWORD, auth=auth, latency=args.latency)
+        try:
+            results['handshake'][auth] = asyncio.run(
+                bench_handshake(sim.sim.port, args.rounds))
+            if auth == bticino_sim.AUTH_HMAC:
+                results['rtt'] = asyncio.run(
+                    bench_rtt(sim.sim.port, args.rounds, args.window))
+                results['monitor'] = asyncio.run(
+                    bench_monitor(sim, args.frames, args.burst))
+        finally:
+            sim.close()
+    results['decode'] = bench_decode(args.frames)
+    return results
+
+
+def flatten(results, prefix=''):
+    for key, value in results.items():
+        if isinstance(value, dict) and key != 'params':
+            yield from flatten(value, prefix + key + '.')
+        elif isinstance(value, float):
+            yield prefix + key, value
+
+
+def regressions(results, baseline, tolerance):
+    """Metrics more than 'tolerance' (fraction) worse than the baseline."""
+    old = dict(flatten(baseline))
+    worse = []
+    for key, value in flatten(results):
+        if key not in old or not old[key] or key.endswith(('max_ms', 'p99_ms')):
+            continue    # tail latencies are too noisy to gate on
+        change = value / old[key] - 1
+        if key.endswith('per_s'):
+            change = -change
+        if change > tolerance:
+            worse.append((key, old[key], value))
+    return worse
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=200,
+                        help='handshakes and commands measured')
+    parser.add_argument('--frames', type=int, default=50000,
+                        help='monitor frames measured')
+    parser.add_argument('--burst', type=int, default=50,
+                        help='monitor frames emitted back to back')
+    parser.add_argument('--window', type=int, default=bticino.WINDOW)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='simulated gateway reply latency, seconds')
+    parser.add_argument('--label', default='')
+    parser.add_argument('--output', help='also write the JSON to this file')
+    parser.add_argument('--baseline', help='JSON of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative slowdown against --baseline')
+    args = parser.parse_args()
+
+    results = run(args)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            worse = regressions(results, json.load(f), args.tolerance)
+        for key, old, new in worse:
+            print('regression: %s %.3f -> %.3f' % (key, old, new), file=sys.stderr)
+        if worse:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Microbenchmark of the HMAC handshake answer: HmacHandshake against the
+original per-call hmacChallenge() implementation kept below as reference.
+
+Run from the repository root:
+    python benchmarks/handshake.py [--rounds 20000]
+"""
+
+import os
+import sys
+import time
+import random
+import hashlib
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bticino  # noqa: E402
+
+
+def legacy_nums2hex(indata):
+    hexstr = ""
+    for (n1, n2) in zip(indata[0::2], indata[1::2]):
+        hexstr += "%1x" % int(n1+n2)
+    return hexstr
+
+
+def legacy_hexstr2nums(hexstr):
+    numstr = ""
+    for hexnum in hexstr:
+        numstr += "%02d" % int(hexnum, 16)
+    return numstr
+
+
+def legacy_hmac_challenge(frame, password):
+    password = str(password)
+    inhex = legacy_nums2hex(frame[2:])
+    hex_pwd_digest = hashlib.sha256(password.encode()).hexdigest()
+    hex_rnd_digest = hashlib.sha256(b"xx").hexdigest()
+    random_nums = legacy_hexstr2nums(hex_rnd_digest)
+    uuid = inhex + hex_rnd_digest + "736F70653E" + "636F70653E" + hex_pwd_digest
+    hex_uuid_digest = hashlib.sha256(uuid.encode()).hexdigest()
+    return [random_nums, legacy_hexstr2nums(hex_uuid_digest)]
+
+
+def server_nonce(rnd):
+    return '*#' + ''.join('%02d' % rnd.randrange(16) for _ in range(64))
+
+
+def bench(func, frames):
+    start = time.perf_counter()
+    for frame in frames:
+        func(frame)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=20000)
+    parser.add_argument('--password', default='12345')
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    frames = [server_nonce(rnd) for _ in range(args.rounds)]
+
+    fixed = bticino.HmacHandshake(args.password, randomNonce=False)
+    for frame in frames[:100]:
+        if fixed.answer(frame) != legacy_hmac_challenge(frame, args.password):
+            sys.exit('HmacHandshake differs from the original hmacChallenge()')
+
+    randomized = bticino.HmacHandshake(args.password)
+    results = (
+        ('original hmacChallenge', bench(
+            lambda f: legacy_hmac_challenge(f, args.password), frames)),
+        ('HmacHandshake fixed', bench(fixed.answer, frames)),
+        ('HmacHandshake random', bench(randomized.answer, frames)),
+    )
+    base = results[0][1]
+    print('rounds=%d' % args.rounds)
+    for name, seconds in results:
+        print('%-24s %8.3fs %9.1f us/answer %6.1fx' % (
+            name, seconds, 1e6 * seconds / args.rounds, base / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,19 +4,90 @@ import time
 import hmac
 import hashlib
 import asyncio
+import collections
+import contextlib
+import random
+import functools
+import secrets
+import sys
+import os
+import struct
+import threading
+import bisect
+import weakref
+import json
+import argparse
+
+try:
+    import numpy
+except ImportError:     # only needed by ChallengeEngine.batch()
+    numpy = None
 
 LOGGER = logging.getLogger(__name__)
 LOGGER.setLevel(logging.DEBUG)
 
 # Acknowledge (OPEN message OK)
 ACK="*#*1"
+ACK_FRAME=b"*#*1##"
 # Not-Acknowledge (OPEN message wrong)
 NACK="*#*0"
+NACK_FRAME=b"*#*0##"
 # Monitor session
 MONITOR="*99*1##"
 # Commands session
-#COMMANDS="*99*0##"
+COMMANDS="*99*0##"
 SPECIAL="*99*9##"
+# Frame terminator
+TERMINATOR=b"##"
+# Bytes requested from the socket per read
+READ_SIZE=4096
+# Longest partial frame kept while waiting for its terminator
+MAX_FRAME=1024
+# Commands in flight per session
+WINDOW=4
+# Seconds before an unanswered command fails
+REQUEST_TIMEOUT=5.0
+# Reconnect backoff of supervise(), seconds
+BACKOFF_MIN=1.0
+BACKOFF_MAX=60.0
+# TCP keepalive: idle seconds, seconds between probes, probes before reset
+KEEPALIVE=(10, 5, 3)
+# Seconds without received bytes before a session is probed, None: never
+IDLE_PROBE=30.0
+# Seconds a probe may stay unanswered
+PROBE_TIMEOUT=5.0
+# Cheap status request answering the idle probe, also on MONITOR sessions
+PROBE_FRAME='*#13**15##'
+# Seconds sent data may stay unacknowledged before the kernel drops the
+# connection (TCP_USER_TIMEOUT, Linux), longer than a Wi-Fi roam; None: default
+USER_TIMEOUT=30.0
+# Seconds allowed for connect plus handshake
+HANDSHAKE_TIMEOUT=15.0
+# Queued bytes written at once instead of waiting for the end of the loop iteration
+COALESCE_MAX=16384
+# Seconds query() keeps a (WHO, DIMENSION) reply; unlisted ones: QUERY_TTL.
+# Status requests are only kept for an explicit ttl, commands never.
+DIMENSION_TTL = {
+    (1013, 1): 3600.0,  # device type
+    (1013, 2): 3600.0,  # firmware version
+    (1013, 3): 3600.0,  # hardware version
+    (1013, 6): 3600.0,  # micro version
+    (13, 0): 0.0,       # time
+    (13, 1): 60.0,      # date
+    (13, 10): 300.0,    # ip address
+    (13, 11): 300.0,    # netmask
+    (13, 15): 3600.0,   # device model
+}
+QUERY_TTL=10.0
+# CommandScheduler priority classes, lowest runs first
+PRIORITY_LOCK = 0
+PRIORITY_STATE = 1
+PRIORITY_DIAGNOSTIC = 2
+LOCK_WHATS = (19, 20)   # WHO=8 door lock press/release (21/22 are lights)
+# Subscriber overflow policies
+DROP_OLDEST='drop-oldest'
+DROP_NEWEST='drop-newest'
+BLOCK='block'
 
 
 """
@@ -175,6 +246,52 @@ s: *1000*1001*0##
 def rshift(val, bits):
     return (val >> bits) & ((1 << (32-bits))-1)
 
+# lookup tables of the HMAC handshake digit encoding: every hex digit is
+# sent as two decimal digits ('a' -> '10')
+NUMS2HEX = {'%02d' % i: '%x' % i for i in range(16)}
+HEX2NUMS = {('%x' % i): '%02d' % i for i in range(16)}
+HEX2NUMS.update({k.upper(): v for (k, v) in HEX2NUMS.items()})
+BYTE2NUMS = ['%02d%02d' % (b >> 4, b & 15) for b in range(256)]
+
+def nums2hex(indata):
+    return ''.join([NUMS2HEX[indata[i:i + 2]] for i in range(0, len(indata) - 1, 2)])
+
+def hexstr2nums(hexstr):
+    return ''.join(map(HEX2NUMS.__getitem__, hexstr))
+
+def bytes2nums(data):
+    return ''.join(map(BYTE2NUMS.__getitem__, data))
+
+class HmacHandshake():
+    """
+    Client side of the '*98*2' HMAC-SHA256 handshake for one password.
+
+    The password digest and the constant tail of the hashed string are
+    computed once. The client nonce is random unless randomNonce is False,
+    which keeps the historic fixed sha256(b"xx") value.
+    """
+
+    def __init__(self, password, randomNonce=True):
+        self.password = str(password)
+        pwdDigest = hashlib.sha256(self.password.encode()).hexdigest()
+        self.suffix = ("736F70653E" + "636F70653E" + pwdDigest).encode()
+        self.randomNonce = randomNonce
+        self.fixedNonce = hashlib.sha256(b"xx").digest()
+
+    def clientNonce(self):
+        return secrets.token_bytes(32) if self.randomNonce else self.fixedNonce
+
+    def answer(self, frame, randnums=None):
+        """[client nonce, HMAC] as digit strings for the '*#<nonce>' frame."""
+        if randnums is None:
+            nonce = self.clientNonce()
+            rndHex = nonce.hex()
+            randnums = bytes2nums(nonce)
+        else:
+            rndHex = nums2hex(randnums)
+        digest = hashlib.sha256((nums2hex(frame[2:]) + rndHex).encode() + self.suffix)
+        return [randnums, bytes2nums(digest.digest())]
+
 class ExNoInitAck(Exception):
     pass
 
@@ -184,40 +301,838 @@ class ExDisconnected(Exception):
 class ExWrongToken(Exception):
     pass
 
+class ExBadFrame(ValueError):
+    pass
+
+class FrameDecoder():
+    """
+    Incremental OpenWebNet frame decoder.
+
+    Received bytes are appended to one reusable bytearray; feed() returns
+    every complete '*...##' frame as bytes (terminator included) and keeps
+    a trailing partial frame for the next call. Nothing is decoded to str.
+    """
+
+    def __init__(self, maxFrame=MAX_FRAME):
+        self.buffer = bytearray()
+        self.maxFrame = maxFrame
+        self.scanned = 0    # offset already searched for a terminator
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def reset(self):
+        del self.buffer[:]
+        self.scanned = 0
+
+    def feed(self, data):
+        buf = self.buffer
+        buf += data
+        frames = []
+        pos = 0
+        with memoryview(buf) as view:
+            while True:
+                start = buf.find(b'*', pos)
+                if start < 0:
+                    pos = len(buf)
+                    break
+                end = buf.find(TERMINATOR, max(start + 1, self.scanned - 1))
+                if end < 0:
+                    pos = start
+                    break
+                frames.append(bytes(view[start:end + 2]))
+                pos = end + 2
+                self.scanned = pos
+        if pos:
+            del buf[:pos]
+        self.scanned = max(len(buf) - 1, 0)
+        if len(buf) > self.maxFrame:
+            LOGGER.warning("dropping %d bytes without frame terminator", len(buf))
+            self.reset()
+        return frames
+
+# Message kinds
+MSG_ACK = 0
+MSG_NACK = 1
+MSG_STANDARD = 2            # *WHO*WHAT*WHERE##
+MSG_STATUS_REQUEST = 3      # *#WHO*WHERE##
+MSG_DIMENSION_REQUEST = 4   # *#WHO*WHERE*DIMENSION##
+MSG_DIMENSION = 5           # *#WHO*WHERE*DIMENSION*VAL1*...##  (reply or set)
+MSG_DIMENSION_WRITE = 6     # *#WHO*WHERE*#DIMENSION*VAL1*...##
+
+# WHO families whose frames are memoised by parseFrame()
+FAST_PREFIXES = (b'*8*', b'*#8*', b'*7*', b'*#7*')
+FAST_CACHE_SIZE = 1024
+
+class Message():
+    """
+    One parsed OpenWebNet frame. who, what and dimension are ints, where is
+    an interned str; what/dimension parameters after '#' go to params.
+    Instances can be shared between consumers and must not be modified.
+    """
+    __slots__ = ('kind', 'who', 'what', 'params', 'where', 'dimension', 'values', 'frame')
+
+    def __init__(self, kind, frame, who=None, what=None, params=(), where=None,
+                 dimension=None, values=()):
+        self.kind = kind
+        self.frame = frame
+        self.who = who
+        self.what = what
+        self.params = params
+        self.where = where
+        self.dimension = dimension
+        self.values = values
+
+    def __repr__(self):
+        return "<Message %s>" % self.frame.decode(errors='replace')
+
+ACK_MESSAGE = Message(MSG_ACK, ACK_FRAME)
+NACK_MESSAGE = Message(MSG_NACK, NACK_FRAME)
+
+NUMBERS = {}    # interned ints of WHO/WHAT/DIMENSION fields
+
+def number(field):
+    value = NUMBERS.get(field)
+    if value is None:
+        value = NUMBERS.setdefault(field, int(field))
+    return value
+
+def splitParams(field):
+    """'73#1#100' -> (73, ('1', '100'))"""
+    if '#' not in field:
+        return number(field), ()
+    head, *params = field.split('#')
+    return number(head), tuple(params)
+
+def parseText(frame, text):
+    body = text[:-2] if text.endswith('##') else text
+    try:
+        if body.startswith('*#'):
+            parts = body[2:].split('*')
+            who = number(parts[0])
+            where = sys.intern(parts[1]) if len(parts) > 1 else ''
+            if len(parts) <= 2:
+                return Message(MSG_STATUS_REQUEST, frame, who, where=where)
+            if parts[2].startswith('#'):
+                dimension, params = splitParams(parts[2][1:])
+                return Message(MSG_DIMENSION_WRITE, frame, who, params=params, where=where,
+                               dimension=dimension, values=tuple(parts[3:]))
+            dimension, params = splitParams(parts[2])
+            kind = MSG_DIMENSION_REQUEST if len(parts) == 3 else MSG_DIMENSION
+            return Message(kind, frame, who, params=params, where=where,
+                           dimension=dimension, values=tuple(parts[3:]))
+        if body.startswith('*'):
+            parts = body[1:].split('*')
+            who = number(parts[0])
+            what, params = splitParams(parts[1]) if len(parts) > 1 else (None, ())
+            where = sys.intern(parts[2]) if len(parts) > 2 else ''
+            return Message(MSG_STANDARD, frame, who, what, params, where)
+    except (ValueError, IndexError):
+        pass
+    raise ExBadFrame("not an OpenWebNet frame: %r" % frame)
+
+def parseBytes(frame):
+    try:
+        text = frame.decode('ascii')
+    except UnicodeDecodeError:
+        raise ExBadFrame("not an OpenWebNet frame: %r" % frame) from None
+    return parseText(frame, text)
+
+parseFast = functools.lru_cache(maxsize=FAST_CACHE_SIZE)(parseBytes)
+
+def parseFrame(frame):
+    """
+    Parse a frame (bytes as returned by FrameDecoder, or str) into a
+    Message. ACK/NACK are singletons, and lock (WHO=8) and video door
+    entry (WHO=7) frames, which repeat constantly, are memoised.
+    """
+    if isinstance(frame, str):
+        try:
+            frame = frame.encode('ascii')
+        except UnicodeEncodeError:
+            raise ExBadFrame("not an OpenWebNet frame: %r" % frame) from None
+    if frame == ACK_FRAME:
+        return ACK_MESSAGE
+    if frame == NACK_FRAME:
+        return NACK_MESSAGE
+    if frame.startswith(FAST_PREFIXES):
+        return parseFast(frame)
+    return parseBytes(frame)
+
+# filter key of the subscribers of every frame, and most frames cached by EventBus
+ANY_KEY = (None, None, None)
+ROUTE_CACHE_SIZE = 4096
+
+class Subscription():
+    """
+    Bounded queue of frames for one consumer of an EventBus.
+
+    Iterate with 'async for frame in sub' or call get(); close() detaches.
+    """
+
+    def __init__(self, bus, maxsize, policy, key=ANY_KEY):
+        if policy not in (DROP_OLDEST, DROP_NEWEST, BLOCK):
+            raise ValueError("unknown overflow policy '%s'" % policy)
+        self.bus = bus
+        self.key = key                  # (WHO, WHAT, WHERE) filter, None: any
+        self.policy = policy
+        self.queue = asyncio.Queue(maxsize)
+        self.overflow = collections.deque()  # BLOCK: frames waiting for room
+        self.drained = None     # future of a publisher waiting for the overflow
+        self.dropped = 0
+
+    def offer(self, frame):
+        queue = self.queue
+        if self.overflow or queue.full():
+            if self.policy == DROP_OLDEST:
+                queue.get_nowait()
+                self.dropped += 1
+            elif self.policy == DROP_NEWEST:
+                self.dropped += 1
+                return
+            else:
+                self.overflow.append(frame)
+                return
+        queue.put_nowait(frame)
+
+    def refill(self):
+        """Move BLOCK overflow into the queue as the consumer makes room."""
+        overflow, queue = self.overflow, self.queue
+        while overflow and not queue.full():
+            queue.put_nowait(overflow.popleft())
+        if not overflow and self.drained and not self.drained.done():
+            self.drained.set_result(None)
+
+    async def get(self):
+        frame = await self.queue.get()
+        if self.overflow:
+            self.refill()
+        return frame
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.get()
+
+    def qsize(self):
+        return self.queue.qsize() + len(self.overflow)
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+def routeKey(frame):
+    """
+    (WHO, WHAT, WHERE) of a frame for the EventBus index: WHAT is the
+    DIMENSION of '*#' frames, parameters after '#' are left out, so
+    '*7*73#1#100*##' gives (7, 73, '').
+    """
+    try:
+        msg = parseFrame(frame)
+    except ExBadFrame:
+        return ANY_KEY
+    if msg.kind == MSG_STANDARD:
+        return (msg.who, msg.what, msg.where)
+    return (msg.who, msg.dimension, msg.where)
+
+class EventBus():
+    """
+    Fan-out of the frames of one session to any number of subscribers,
+    each with its own bounded queue and overflow policy. BLOCK subscribers
+    keep what does not fit in an overflow that get() moves into the queue;
+    the publisher awaits drain() before publishing more, which bounds it.
+
+    Subscribers may filter on WHO, WHAT and WHERE (None matches anything).
+    They are indexed by their (WHO, WHAT, WHERE) key, and the subscribers
+    of each key seen are cached, so a frame costs one parse (memoised for
+    WHO 7/8) and one dict lookup whatever the number of subscriptions.
+    frameOf(item) gives the frame of published items that are not frames.
+    """
+
+    def __init__(self, frameOf=None):
+        self.subscribers = []
+        self.frameOf = frameOf
+        self.index = {}         # filter key -> subscribers
+        self.routes = {}        # frame key -> tuple of matching subscribers
+        self.filtered = 0       # subscribers with a filter
+
+    def subscribe(self, maxsize=100, policy=DROP_OLDEST, who=None, what=None, where=None):
+        key = (None if who is None else int(who), None if what is None else int(what),
+               None if where is None else str(where))
+        sub = Subscription(self, maxsize, policy, key)
+        self.subscribers.append(sub)
+        self.index.setdefault(key, []).append(sub)
+        if key != ANY_KEY:
+            self.filtered += 1
+        self.routes.clear()
+        return sub
+
+    def unsubscribe(self, sub):
+        if sub in self.subscribers:
+            self.subscribers.remove(sub)
+            subs = self.index[sub.key]
+            subs.remove(sub)
+            if not subs:
+                del self.index[sub.key]
+            if sub.key != ANY_KEY:
+                self.filtered -= 1
+            self.routes.clear()
+            sub.overflow.clear()
+            if sub.drained and not sub.drained.done():
+                sub.drained.set_result(None)
+
+    def route(self, key):
+        """Subscribers matching a frame key, from the index."""
+        who, what, where = key
+        subs = []
+        for w in {who, None}:
+            for t in {what, None}:
+                for p in {where, None}:
+                    subs += self.index.get((w, t, p), ())
+        if len(self.routes) >= ROUTE_CACHE_SIZE:
+            self.routes.clear()
+        routed = self.routes[key] = tuple(subs)
+        return routed
+
+    def publish(self, item):
+        if not self.filtered:
+            for sub in self.subscribers:
+                sub.offer(item)
+            return
+        key = routeKey(self.frameOf(item) if self.frameOf else item)
+        subs = self.routes.get(key)
+        if subs is None:
+            subs = self.route(key)
+        for sub in subs:
+            sub.offer(item)
+
+    def blocked(self):
+        return any(sub.overflow for sub in self.subscribers)
+
+    async def drain(self):
+        for sub in self.subscribers:
+            while sub.overflow:
+                sub.drained = asyncio.get_event_loop().create_future()
+                await sub.drained
+
+class QueryCache():
+    """
+    TTL cache in front of a request coroutine for status and dimension
+    queries. Concurrent callers asking the same frame share one round trip;
+    only ACKed replies are kept. Other frames raise ValueError: a command
+    must reach the gateway every time.
+    """
+
+    def __init__(self, fetch):
+        self.fetch = fetch
+        self.cache = {}     # frame -> (expires, Reply)
+        self.inflight = {}  # frame -> future
+
+    @staticmethod
+    def ttl(frame):
+        msg = parseFrame(frame)
+        if msg.kind == MSG_DIMENSION_REQUEST:
+            return DIMENSION_TTL.get((msg.who, msg.dimension), QUERY_TTL)
+        if msg.kind == MSG_STATUS_REQUEST:
+            return 0.0
+        raise ValueError("not a status or dimension query: '%s'" % frame)
+
+    async def get(self, frame, ttl=None):
+        default = self.ttl(frame)
+        if ttl is None:
+            ttl = default
+        hit = self.cache.get(frame)
+        if hit and hit[0] > time.monotonic():
+            return hit[1]
+        future = self.inflight.get(frame)
+        if future is None:
+            future = asyncio.ensure_future(self.load(frame, ttl))
+            self.inflight[frame] = future
+            future.add_done_callback(lambda f: self.inflight.pop(frame, None))
+        return await asyncio.shield(future)
+
+    async def load(self, frame, ttl):
+        reply = await self.fetch(frame)
+        if reply.ok and ttl > 0:
+            self.cache[frame] = (time.monotonic() + ttl, reply)
+        return reply
+
+    def invalidate(self, frame=None):
+        if frame is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(frame, None)
+
+# Session log: LOG_MAGIC, then records of RECORD header + frame. Times are
+# monotonic nanoseconds since the last DIR_MARK record, whose payload is
+# the wall-clock time (MARK) the recorder was opened.
+LOG_MAGIC = b"OWNLOG1\n"
+RECORD = struct.Struct('<QBH')   # time ns, direction, frame length
+MARK = struct.Struct('<d')
+DIR_RX = 0
+DIR_TX = 1
+DIR_MARK = 2
+
+class SessionRecorder():
+    """
+    Append-only binary log of the frames of a session; set it as
+    Bticino.recorder. Every open starts a new segment with a DIR_MARK.
+    """
+
+    def __init__(self, path):
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'ab')
+        if new:
+            self.file.write(LOG_MAGIC)
+        self.start = time.monotonic_ns()
+        self.write(DIR_MARK, MARK.pack(time.time()))
+
+    def write(self, direction, frame):
+        self.file.write(RECORD.pack(time.monotonic_ns() - self.start, direction, len(frame)))
+        self.file.write(frame)
+
+    def record(self, direction, frame):
+        if self.file:
+            self.write(direction, frame)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+def readLog(path):
+    """Yield (time ns, direction, payload) of every record of a session log."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(LOG_MAGIC):
+        raise ValueError("%s is not a session log" % path)
+    view = memoryview(data)
+    pos = len(LOG_MAGIC)
+    while pos + RECORD.size <= len(data):
+        t, direction, size = RECORD.unpack_from(data, pos)
+        pos += RECORD.size
+        if pos + size > len(data):
+            break               # truncated by a crash while writing
+        yield t, direction, bytes(view[pos:pos + size])
+        pos += size
+
+async def replayLog(path, target, speed=1.0, directions=(DIR_RX,)):
+    """
+    Feed the frames of a session log to target(frame), e.g.
+    Bticino.handleFrame or GatewaySimulator.emit, keeping the recorded
+    timing divided by speed; speed None or 0 replays as fast as possible.
+    Returns the number of frames replayed.
+    """
+    count = 0
+    origin = None
+    for t, direction, frame in readLog(path):
+        if direction == DIR_MARK:
+            origin = None       # new segment, its clock restarts
+            continue
+        if direction not in directions:
+            continue
+        if speed:
+            now = time.monotonic()
+            if origin is None:
+                origin = now - t / 1e9 / speed
+            wait = origin + t / 1e9 / speed - now
+            if wait > 0:
+                await asyncio.sleep(wait)
+        target(frame)
+        count += 1
+        if not speed and count % 1000 == 0:
+            await asyncio.sleep(0)
+    return count
+
+Reply = collections.namedtuple('Reply', 'frame ok frames')
+Reply.__doc__ = """Outcome of one command: ok is True on ACK, frames holds the replies."""
+
+class Request():
+    """
+    One command waiting for its ACK/NACK.
+
+    Dimension requests ('*#WHO*WHERE*DIM##') also wait for a reply frame
+    starting with '*#WHO*WHERE*DIM*'; the gateway sends it before or after
+    the ACK. Status requests ('*#WHO*WHERE##') collect the '*WHO*...'
+    frames that arrive before their ACK.
+    """
+    __slots__ = ('frame', 'future', 'frames', 'acked', 'ok', 'prefix', 'needValue', 'timer', 'sent')
+
+    def __init__(self, frame, future):
+        self.frame = frame
+        self.future = future
+        self.sent = time.monotonic()
+        self.frames = []
+        self.acked = False
+        self.ok = False
+        self.prefix = None
+        self.needValue = False
+        self.timer = None
+        if frame.startswith('*#') and frame.endswith('##'):
+            parts = frame[2:-2].split('*')
+            if len(parts) == 2:
+                self.prefix = ('*%s*' % parts[0]).encode(), ('*#%s*' % parts[0]).encode()
+            elif len(parts) == 3 and parts[2] and not parts[2].startswith('#'):
+                self.prefix = (frame[:-2] + '*').encode()
+                self.needValue = True
+
+    def expire(self):
+        if not self.future.done():
+            self.future.set_exception(asyncio.TimeoutError(
+                "no reply to '%s'" % self.frame))
+
+# upper bounds, seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+class Histogram():
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)   # last one: above every bound
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum,
+                'buckets': dict(zip(self.bounds + (float('inf'),), self.counts))}
+
+# Metrics attribute -> (Prometheus name, help)
+METRIC_COUNTERS = {
+    'framesReceived': ('bticino_frames_received_total', 'Frames received'),
+    'framesSent': ('bticino_frames_sent_total', 'Frames sent'),
+    'bytesReceived': ('bticino_bytes_received_total', 'Bytes received'),
+    'bytesSent': ('bticino_bytes_sent_total', 'Bytes sent'),
+    'writes': ('bticino_writes_total', 'Socket writes, several frames each when coalesced'),
+    'commands': ('bticino_commands_total', 'Commands answered'),
+    'nacks': ('bticino_nacks_total', 'Commands answered with NACK'),
+    'timeouts': ('bticino_timeouts_total', 'Commands without reply in time'),
+    'connects': ('bticino_connects_total', 'Successful handshakes of supervised sessions'),
+    'reconnects': ('bticino_reconnects_total', 'Reconnections after a lost session'),
+    'handshakeFailures': ('bticino_handshake_failures_total', 'Failed handshakes'),
+    'deadSessions': ('bticino_dead_sessions_total', 'Sessions dropped by the idle probe'),
+}
+
+class Metrics():
+    """
+    Counters and latency histograms of Bticino sessions.
+
+    Disabled (Bticino.metrics is None) it costs one attribute test per read
+    or send; enabled it only bumps preallocated counters and buckets. Read
+    it with snapshot() or prometheus(); queue depths are sampled from the
+    attached sessions at that time.
+    """
+
+    def __init__(self, labels=None):
+        self.labels = dict(labels or {})
+        for name in METRIC_COUNTERS:
+            setattr(self, name, 0)
+        self.handshakeSeconds = Histogram()
+        self.commandSeconds = {}    # WHO -> Histogram
+        self.sessions = weakref.WeakSet()
+
+    def attach(self, session):
+        session.metrics = self
+        self.sessions.add(session)
+        return session
+
+    def command(self, frame, seconds, ok):
+        self.commands += 1
+        if not ok:
+            self.nacks += 1
+        who = frame[1:].lstrip('#').split('*', 1)[0]
+        hist = self.commandSeconds.get(who)
+        if hist is None:
+            hist = self.commandSeconds[who] = Histogram()
+        hist.observe(seconds)
+
+    def gauges(self):
+        pending = depth = dropped = 0
+        for session in self.sessions:
+            pending += len(session.pending)
+            for sub in session.bus.subscribers:
+                depth += sub.qsize()
+                dropped += sub.dropped
+        return {'pendingRequests': pending, 'queueDepth': depth, 'queueDropped': dropped}
+
+    def snapshot(self):
+        snap = {name: getattr(self, name) for name in METRIC_COUNTERS}
+        snap['nackRate'] = self.nacks / self.commands if self.commands else 0.0
+        snap['handshakeSeconds'] = self.handshakeSeconds.snapshot()
+        snap['commandSeconds'] = {who: h.snapshot() for (who, h) in self.commandSeconds.items()}
+        snap.update(self.gauges())
+        return snap
+
+    def labelText(self, extra=None):
+        labels = dict(self.labels, **(extra or {}))
+        if not labels:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                                 for (k, v) in sorted(labels.items()))
+
+    def histogramLines(self, name, hist, extra=None):
+        total = 0
+        for bound, count in zip(hist.bounds + (float('inf'),), hist.counts):
+            total += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            yield '%s_bucket%s %d' % (name, self.labelText(dict(extra or {}, le=le)), total)
+        yield '%s_sum%s %r' % (name, self.labelText(extra), hist.sum)
+        yield '%s_count%s %d' % (name, self.labelText(extra), hist.count)
+
+    def prometheus(self):
+        """Prometheus text exposition format."""
+        lines = []
+        for attr, (name, help) in METRIC_COUNTERS.items():
+            lines += ['# HELP %s %s' % (name, help), '# TYPE %s counter' % name,
+                      '%s%s %d' % (name, self.labelText(), getattr(self, attr))]
+        for attr, value in self.gauges().items():
+            name = 'bticino_' + ''.join('_' + c.lower() if c.isupper() else c for c in attr)
+            lines += ['# TYPE %s gauge' % name, '%s%s %d' % (name, self.labelText(), value)]
+        lines += ['# HELP bticino_handshake_seconds Connect plus handshake duration',
+                  '# TYPE bticino_handshake_seconds histogram']
+        lines += self.histogramLines('bticino_handshake_seconds', self.handshakeSeconds)
+        lines += ['# HELP bticino_command_seconds Command round trip by WHO',
+                  '# TYPE bticino_command_seconds histogram']
+        for who, hist in sorted(self.commandSeconds.items()):
+            lines += self.histogramLines('bticino_command_seconds', hist, {'who': who})
+        return '\n'.join(lines) + '\n'
+
 class Bticino():
-    def __init__(self, mode_command=MONITOR, host='localhost', port=20000):
+    def __init__(self, mode_command=MONITOR, host='localhost', port=20000, password=710299916):
         super().__init__()
         self.sock = None
         self.host = host
         self.port = port
         self.running = False
-        self.password = 710299916
+        self.password = password
         self.mode_command = mode_command    # monitor or commands
         self.reader = None
         self.writer = None
+        self.decoder = FrameDecoder()
+        self.frames = collections.deque()   # decoded, not yet consumed
+        self.window = WINDOW
+        self.slots = None                   # semaphore limiting the window
+        self.pending = collections.deque()  # Request objects, oldest left
+        self.receiver = None
+        self.listeners = []                 # callbacks for unsolicited frames
+        self.bus = EventBus()
+        self.addListener(self.bus.publish)
+        self.buses = [self.bus]             # buses fed by listeners, see oneLoop()
+        self.supervising = False
+        self.stopped = None                 # Event set by stop(), ends the backoff
+        self.stats = {'connects': 0, 'reconnects': 0, 'downtime': 0.0,
+                      'lastError': None}
+        self.lostAt = None                  # monotonic time of last disconnect
+        self.handshake = None               # HmacHandshake for self.password
+        self.randomNonce = True             # False: legacy fixed client nonce
+        self.queries = QueryCache(self.request)
+        self.recorder = None                # SessionRecorder of sent/received frames
+        self.handshakes = None              # semaphore capping concurrent handshakes
+        self.metrics = None                 # Metrics, see Metrics.attach()
+        self.keepalive = KEEPALIVE          # None: leave the socket defaults
+        self.idleProbe = IDLE_PROBE
+        self.probeTimeout = PROBE_TIMEOUT
+        self.userTimeout = USER_TIMEOUT
+        self.lastRx = 0.0                   # monotonic time of the last read
+        self.draining = False               # reading held back by a BLOCK subscriber
+        self.watchdog = None
+        self.outOfStep = False              # a command timed out, see expire()
+        self.coalesce = True                # False: one write() per frame
+        self.outbox = []                    # frames waiting for flush()
+        self.outboxSize = 0
+        self.flusher = None                 # call_soon handle of flush()
 
     async def close(self):
+       if self.receiver and self.receiver is not asyncio.current_task():
+            self.receiver.cancel()
+       self.receiver = None
+       if self.watchdog and self.watchdog is not asyncio.current_task():
+            self.watchdog.cancel()
+       self.watchdog = None
+       if self.flusher:
+            self.flusher.cancel()
+            self.flusher = None
+       self.outbox.clear()
+       self.outboxSize = 0
+       self.failPending(ExDisconnected())
        if self.writer:
-            self.writer.close()
-            await self.writer.wait_closed()
+            writer, self.writer = self.writer, None
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
             LOGGER.info("closed connection to %s", self.host)
 
+    def isAlive(self):
+        return (self.writer is not None and not self.writer.is_closing()
+                and not self.reader.at_eof() and not self.outOfStep
+                and (self.receiver is None or not self.receiver.done()))
+
     async def send(self, data):
         LOGGER.debug("sending: '%s'", data)
-        self.writer.write(data.encode())
-        await self.writer.drain()
+        data = data.encode()
+        if self.recorder:
+            self.recorder.record(DIR_TX, data)
+        if self.metrics:
+            self.metrics.framesSent += 1
+            self.metrics.bytesSent += len(data)
+        writer = self.writer
+        if not self.coalesce:
+            self.write(writer, data)
+        elif self.flusher is None:
+            # first frame of this loop iteration: out at once, lowest
+            # latency; the following ones wait for flush()
+            self.write(writer, data)
+            self.flusher = asyncio.get_running_loop().call_soon(self.flush)
+        else:
+            self.outbox.append(data)
+            self.outboxSize += len(data)
+            if self.outboxSize < COALESCE_MAX:
+                return
+            self.flush()
+        await writer.drain()
+
+    def write(self, writer, data):
+        if self.metrics:
+            self.metrics.writes += 1
+        writer.write(data)
+
+    def flush(self):
+        """Write the frames queued by send() with one writelines()."""
+        self.flusher = None
+        if not self.outbox:
+            return
+        outbox, self.outbox = self.outbox, []
+        self.outboxSize = 0
+        if self.writer is None or self.writer.is_closing():
+            return
+        if self.metrics:
+            self.metrics.writes += 1
+        self.writer.writelines(outbox)
+        # keep the iteration marked, so a burst continues to coalesce
+        self.flusher = asyncio.get_running_loop().call_soon(self.flush)
 
-    async def run(self):
+    async def connect(self):
         LOGGER.info("connecting to '%s', port=%d", self.host, self.port)
         self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.setSocketOptions(self.writer.get_extra_info('socket'))
+        self.lastRx = time.monotonic()
+        self.decoder.reset()
+        self.frames.clear()
+        self.slots = asyncio.Semaphore(self.window)
+        self.outOfStep = False
         LOGGER.info("Starting bticino session '%s'", self.mode_command)
 
+    def setSocketOptions(self, sock):
+        """
+        No Nagle delay for the small interactive frames, and kernel side
+        dead peer detection where the platform has the options.
+        """
+        if sock is None:
+            return
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        options = []
+        if self.keepalive is not None:
+            idle, interval, count = self.keepalive
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            options += [('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', interval),
+                        ('TCP_KEEPCNT', count)]
+        if self.userTimeout is not None:
+            options.append(('TCP_USER_TIMEOUT', int(self.userTimeout * 1000)))
+        for name, value in options:
+            option = getattr(socket, name, None)
+            if option is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, option, value)
+
+    def startWatchdog(self):
+        if self.idleProbe and self.watchdog is None:
+            self.watchdog = asyncio.ensure_future(self.watch())
+
+    async def watch(self):
+        """
+        Probe the gateway when nothing was received for idleProbe seconds
+        and abort the session when it stays silent. A command session must
+        answer PROBE_FRAME within probeTimeout. A MONITOR session has no
+        pending requests: it gets PROBE_FRAME too and must have received
+        something within probeTimeout, its answer or any event.
+        """
+        probed = 0.0
+        while True:
+            wait = max(self.lastRx, probed) + self.idleProbe - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            probed = time.monotonic()
+            if self.draining:
+                continue
+            seen = self.lastRx
+            try:
+                if self.mode_command == MONITOR:
+                    await asyncio.wait_for(self.send(PROBE_FRAME), self.probeTimeout)
+                    await asyncio.sleep(self.probeTimeout)
+                else:
+                    await asyncio.wait_for(self.request(PROBE_FRAME, self.probeTimeout),
+                                           2 * self.probeTimeout)
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                LOGGER.debug("probe of %s failed: %r", self.host, e)
+            # not read while draining: the answer may wait in the socket
+            if (self.lastRx != seen or self.draining) and not self.outOfStep:
+                continue
+            LOGGER.warning("no answer from %s in %.1fs, dropping the session",
+                           self.host, self.idleProbe + self.probeTimeout)
+            if self.metrics:
+                self.metrics.deadSessions += 1
+            if self.writer is not None:
+                self.writer.transport.abort()
+            return
+
+    async def start(self):
+        """Connect and authenticate, without entering the receive loop."""
+        limit = self.handshakes
+        if limit:
+            await limit.acquire()
+        try:
+            began = time.monotonic()
+            await asyncio.wait_for(self.connect(), HANDSHAKE_TIMEOUT)
+            try:
+                await asyncio.wait_for(self.runPrepare(), HANDSHAKE_TIMEOUT)
+            except:
+                if self.metrics:
+                    self.metrics.handshakeFailures += 1
+                await self.close()
+                raise
+            if self.metrics:
+                self.metrics.handshakeSeconds.observe(time.monotonic() - began)
+        finally:
+            if limit:
+                limit.release()
+
+    async def run(self):
+        await self.start()
+
         self.running = True
         try:
-            await self.runPrepare()
+            self.connected()
+            self.startWatchdog()
 
             while self.running:
                 await self.oneLoop()
+        except ExDisconnected:
+            if self.running:    # not closed by stop()
+                LOGGER.exception("during run:")
+                raise
         except:
             LOGGER.exception("during run:")
             raise
@@ -225,18 +1140,254 @@ class Bticino():
             await self.close()
         LOGGER.info("exiting session %s", self.mode_command)
 
+    async def readChunk(self):
+        data = await self.reader.read(READ_SIZE)
+        if not data:
+            raise ExDisconnected()
+        self.lastRx = time.monotonic()
+        frames = self.decoder.feed(data)
+        if self.metrics:
+            self.metrics.framesReceived += len(frames)
+            self.metrics.bytesReceived += len(data)
+        if self.recorder:
+            for frame in frames:
+                self.recorder.record(DIR_RX, frame)
+        self.frames.extend(frames)
+
+    async def readFrame(self):
+        while not self.frames:
+            await self.readChunk()
+        return self.frames.popleft()
+
+    async def oneLoop(self):
+        if not self.frames:
+            await self.readChunk()
+        frames = self.frames
+        while frames:
+            self.handleFrame(frames.popleft())
+        # BLOCK subscribers hold back reading, the gateway then waits on TCP
+        for bus in self.buses:
+            if bus.blocked():
+                self.draining = True
+                try:
+                    await bus.drain()
+                finally:
+                    self.draining = False
+
+    def handleFrame(self, frame):
+        """Called with every received frame (bytes, '##' included)."""
+        LOGGER.debug("rec frame: %s", frame)
+        if self.pending and self.correlate(frame):
+            return
+        for listener in self.listeners:
+            try:
+                listener(frame)
+            except Exception:
+                # a broken consumer must not take the session down
+                LOGGER.exception("listener %r failed on %s", listener, frame)
+
+    def addListener(self, callback):
+        """
+        Call callback(frame) for every frame not answering a request. The
+        registration belongs to this object, so it survives reconnects.
+        """
+        self.listeners.append(callback)
+
+    def removeListener(self, callback):
+        self.listeners.remove(callback)
+
+    def subscribe(self, maxsize=100, policy=DROP_OLDEST, who=None, what=None, where=None):
+        """Queue of the frames received on this session, see EventBus."""
+        return self.bus.subscribe(maxsize, policy, who, what, where)
+
+    def connected(self):
+        stats = self.stats
+        stats['connects'] += 1
+        if self.metrics:
+            self.metrics.connects += 1
+        if self.lostAt is not None:
+            if self.metrics:
+                self.metrics.reconnects += 1
+            down = time.monotonic() - self.lostAt
+            stats['reconnects'] += 1
+            stats['downtime'] += down
+            LOGGER.info("reconnected to %s after %.1fs (reconnect #%d)",
+                        self.host, down, stats['reconnects'])
+            self.lostAt = None
+
+    async def supervise(self, minDelay=BACKOFF_MIN, maxDelay=BACKOFF_MAX):
+        """
+        run() until stop(): after a disconnect or a failed handshake wait
+        with jittered exponential backoff, then connect and handshake again.
+        """
+        self.supervising = True
+        self.stopped = asyncio.Event()
+        delay = minDelay
+        while self.supervising:
+            connects = self.stats['connects']
+            try:
+                await self.run()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # also malformed gateway frames (KeyError, ExBadFrame...):
+                # reconnect rather than leave the session down for good
+                self.stats['lastError'] = repr(e)
+            if not self.supervising:
+                break
+            if self.lostAt is None:
+                self.lostAt = time.monotonic()
+            if self.stats['connects'] != connects:
+                delay = minDelay    # the handshake worked, start over
+            wait = delay * random.uniform(0.5, 1.0)
+            LOGGER.warning("session to %s lost (%s), retrying in %.1fs",
+                           self.host, self.stats['lastError'], wait)
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.stopped.wait(), wait)
+            delay = min(delay * 2, maxDelay)
+        LOGGER.info("supervisor for %s stopped", self.host)
+
+    def stop(self):
+        self.supervising = False
+        self.running = False
+        if self.stopped:
+            self.stopped.set()
+        if self.writer:
+            self.writer.close()
+
+    def listen(self):
+        """Receive in the background after start(), resolving requests."""
+        self.receiver = asyncio.ensure_future(self.receive())
+        self.startWatchdog()
+
+    async def receive(self):
+        try:
+            while True:
+                await self.oneLoop()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            LOGGER.debug("receiving from %s stopped: %r", self.host, e)
+            self.failPending(e)
+            if self.writer:
+                self.writer.close()
+
+    async def submit(self, frame, timeout=REQUEST_TIMEOUT):
+        """
+        Send a command once a window slot is free and return a future
+        resolving to its Reply. Several submits may be in flight at once.
+        """
+        if self.outOfStep:
+            raise ExDisconnected("replies out of step after a timeout, reconnect")
+        await self.slots.acquire()
+        loop = asyncio.get_running_loop()
+        req = Request(frame, loop.create_future())
+        req.future.add_done_callback(lambda f: self.slots.release())
+        self.pending.append(req)
+        try:
+            await self.send(frame)
+        except Exception as e:
+            self.pending.remove(req)
+            req.future.set_exception(e)
+            raise
+        if timeout:
+            req.timer = loop.call_later(timeout, self.expire, req)
+        return req.future
+
+    def expire(self, req):
+        """
+        Replies carry no request id: once a command went unanswered, a later
+        ACK could belong to it or to the next command. The session is marked
+        out of step, isAlive() turns False and it takes no more commands.
+        """
+        if req in self.pending:
+            self.pending.remove(req)
+        if not req.future.done():
+            if self.metrics:
+                self.metrics.timeouts += 1
+            self.outOfStep = True
+            LOGGER.warning("no reply to '%s' from %s, session out of step", req.frame, self.host)
+        req.expire()
+
+    async def request(self, frame, timeout=REQUEST_TIMEOUT):
+        return await (await self.submit(frame, timeout))
+
+    async def pipeline(self, frames, timeout=REQUEST_TIMEOUT):
+        futures = [await self.submit(f, timeout) for f in frames]
+        return await asyncio.gather(*futures)
+
+    async def query(self, frame, ttl=None):
+        """
+        request() for a status or dimension query such as '*#1013**2##',
+        answered from cache within the TTL of that dimension. Status
+        requests ('*#8*20##') are cached only for an explicit ttl.
+        """
+        return await self.queries.get(frame, ttl)
+
+    def correlate(self, frame):
+        if frame == ACK_FRAME or frame == NACK_FRAME:
+            for req in self.pending:
+                if not req.acked:
+                    break
+            else:
+                return False
+            req.acked = True
+            req.ok = frame == ACK_FRAME
+            if not req.ok or not req.needValue or req.frames:
+                self.complete(req)
+            return True
+        for req in self.pending:
+            if req.prefix and frame.startswith(req.prefix):
+                req.frames.append(frame)
+                if req.acked:
+                    self.complete(req)
+                return True
+        return False
+
+    def complete(self, req):
+        self.pending.remove(req)
+        if req.timer:
+            req.timer.cancel()
+        if self.metrics:
+            self.metrics.command(req.frame, time.monotonic() - req.sent, req.ok)
+        if not req.future.done():
+            req.future.set_result(Reply(req.frame, req.ok, req.frames))
+
+    def failPending(self, exc):
+        pending, self.pending = self.pending, collections.deque()
+        for req in pending:
+            if req.timer:
+                req.timer.cancel()
+            if not req.future.done():
+                req.future.set_exception(exc)
+
+    async def voicemail(self, enable):
+        """Toggle the answering machine; the four frames are pipelined."""
+        if enable:
+            frames = ["*7*73#1#100*##", "*8*91##", "*#8**40*1*0*9815*1*25##", "*8*91*##"]
+        else:
+            frames = ["*7*73#1#100*##", "*8*92##", "*#8**40*0*0*9815*1*25##", "*8*92*##"]
+        return await self.pipeline(frames)
+
+    async def unlock(self, where='20', hold=1.0):
+        """Press and release the lock button of WHERE (device type + address)."""
+        press = await self.request("*8*19*%s##" % where)
+        if not press.ok:
+            LOGGER.error("door %s not opened: %s", where, press)
+            return False
+        await asyncio.sleep(hold)
+        release = await self.request("*8*20*%s##" % where)
+        if not release.ok:
+            LOGGER.error("door %s not released: %s", where, release)
+        return release.ok
+
     async def runPrepare(self):
         state = 'init'
 
         while True:
-            frame = await self.reader.read(150)
-            if not frame:
-                raise ExDisconnected()
-
-            frame = frame.decode()
+            frame = await self.readFrame()
             LOGGER.debug("rec frame: %s", frame)
-            frames = frame.split('##')
-            frame = frames[0]
+            frame = frame[:-2].decode()
 
             if state == 'init':
                 if frame != ACK:
@@ -264,6 +1415,8 @@ class Bticino():
                 state = 'auth_resp'
                 continue
             if state == 'auth_resp':
+                if frame == NACK:
+                    raise ExWrongToken("HMAC answer rejected")
                 await self.send("*#*1##")
                 state = 'auth_ack'
                 return
@@ -274,10 +1427,7 @@ class Bticino():
 
     @staticmethod
     def nums2hex(indata):
-        hexstr = ""
-        for (n1, n2) in zip(indata[0::2], indata[1::2]):
-            hexstr += "%1x" % int(n1+n2)
-        return hexstr
+        return nums2hex(indata)
 
     @staticmethod
     def hexstr2nums(hexstr):
@@ -285,41 +1435,14 @@ class Bticino():
         in: 2A
         out: 0210
         """
-
-        numstr = ""
-        for hexnum in hexstr:
-            numstr += "%02d" % int(hexnum, 16)
-        return numstr
+        return hexstr2nums(hexstr)
 
     def hmacChallenge(self, frame, password, randnumsdigest=None):
         LOGGER.debug("frame to challenge: %s", frame)
 
-        password = str(password)
-
-        inhex = self.nums2hex(frame[2:])
-
-        m = hashlib.sha256()
-        m.update(password.encode())
-        hex_pwd_digest = m.hexdigest()
-
-        if randnumsdigest is None:
-            m = hashlib.sha256()
-            m.update(b"xx")          # "random" digest
-            hex_rnd_digest = m.hexdigest()
-            random_nums = self.hexstr2nums(hex_rnd_digest)
-        else:
-            hex_rnd_digest = self.nums2hex(randnumsdigest)
-            random_nums = randnumsdigest
-            LOGGER.debug("use predefined rand digest: %s", random_nums)
-
-        uuid = inhex + hex_rnd_digest + "736F70653E" + "636F70653E" + hex_pwd_digest
-
-        m = hashlib.sha256()
-        m.update(uuid.encode())
-        hex_uuid_digest = m.hexdigest()
-        num_uuid_digest = self.hexstr2nums(hex_uuid_digest)
-
-        tmp = [random_nums, num_uuid_digest]
+        if self.handshake is None or self.handshake.password != str(password):
+            self.handshake = HmacHandshake(password, self.randomNonce)
+        tmp = self.handshake.answer(frame, randnumsdigest)
         LOGGER.debug("challenge: %s", tmp)
         return tmp
 
@@ -360,3 +1483,798 @@ class Bticino():
         j &= 0xFFFFFFFF
 #        LOGGER.debug("answer=%s", str(j))
         return str(j)
+
+
+class SessionPool():
+    """
+    Pool of authenticated COMMAND sessions to one gateway.
+
+    Sessions are opened (TCP connect + runPrepare() handshake) ahead of
+    time, so acquire() normally hands out a ready session. Between minSize
+    and maxSize sessions are kept; idle ones above minSize are closed after
+    idleTimeout seconds, and dead ones are dropped by a periodic check.
+    """
+
+    def __init__(self, host='localhost', port=20000, password=710299916,
+                 minSize=1, maxSize=4, idleTimeout=60.0, checkInterval=10.0):
+        if not 0 <= minSize <= maxSize or maxSize < 1:
+            raise ValueError("invalid pool size %d..%d" % (minSize, maxSize))
+        self.host = host
+        self.port = port
+        self.password = password
+        self.minSize = minSize
+        self.maxSize = maxSize
+        self.idleTimeout = idleTimeout
+        self.checkInterval = checkInterval
+        self.idle = collections.deque()     # (session, released at), oldest left
+        self.size = 0                       # idle + acquired + opening
+        self.cond = asyncio.Condition()
+        self.closed = False
+        self.maintainer = None
+        self.queries = QueryCache(self.request)
+        self.handshakes = None      # shared with the sessions, see Bticino
+        self.metrics = None
+
+    def newSession(self):
+        session = Bticino(COMMANDS, self.host, self.port, self.password)
+        session.handshakes = self.handshakes
+        if self.metrics:
+            self.metrics.attach(session)
+        return session
+
+    async def openSession(self):
+        session = self.newSession()
+        try:
+            await session.start()
+        except BaseException:
+            await session.close()
+            raise
+        session.listen()
+        return session
+
+    async def start(self):
+        # the periodic check keeps refilling if the gateway is down now
+        self.maintainer = asyncio.ensure_future(self.maintain())
+        await self.fill()
+
+    async def close(self):
+        self.closed = True
+        if self.maintainer:
+            self.maintainer.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.maintainer
+        async with self.cond:
+            sessions = [s for (s, _) in self.idle]
+            self.idle.clear()
+            self.size -= len(sessions)
+            self.cond.notify_all()
+        await asyncio.gather(*(s.close() for s in sessions))
+
+    async def acquire(self):
+        stale = []
+        async with self.cond:
+            while True:
+                if self.closed:
+                    raise RuntimeError("session pool is closed")
+                while self.idle:
+                    session, _ = self.idle.pop()
+                    if session.isAlive():
+                        break
+                    stale.append(session)
+                    self.size -= 1
+                else:
+                    session = None
+                if session or self.size < self.maxSize:
+                    break
+                await self.cond.wait()
+            if session is None:
+                self.size += 1
+        for s in stale:
+            await s.close()
+        if session:
+            return session
+        try:
+            return await self.openSession()
+        except BaseException:
+            async with self.cond:
+                self.size -= 1
+                self.cond.notify()
+            raise
+
+    async def release(self, session, discard=False):
+        keep = not discard and not self.closed and session.isAlive()
+        async with self.cond:
+            if keep:
+                self.idle.append((session, time.monotonic()))
+            else:
+                self.size -= 1
+            self.cond.notify()
+        if not keep:
+            await session.close()
+
+    @contextlib.asynccontextmanager
+    async def session(self):
+        session = await self.acquire()
+        try:
+            yield session
+        except BaseException:
+            await self.release(session, discard=True)
+            raise
+        await self.release(session)
+
+    async def request(self, frame, timeout=REQUEST_TIMEOUT):
+        async with self.session() as session:
+            return await session.request(frame, timeout)
+
+    async def query(self, frame, ttl=None):
+        """Bticino.query() with one cache shared by all pool sessions."""
+        return await self.queries.get(frame, ttl)
+
+    async def unlock(self, where='20', hold=1.0):
+        async with self.session() as session:
+            return await session.unlock(where, hold)
+
+    async def fill(self):
+        while not self.closed:
+            async with self.cond:
+                if self.size >= self.minSize:
+                    return
+                self.size += 1
+            try:
+                session = await self.openSession()
+            except BaseException:
+                async with self.cond:
+                    self.size -= 1
+                raise
+            await self.release(session)
+
+    async def check(self):
+        """Close dead and expired idle sessions, then refill to minSize."""
+        now = time.monotonic()
+        drop = []
+        async with self.cond:
+            keep = collections.deque()
+            for (session, since) in self.idle:
+                expired = (now - since > self.idleTimeout
+                           and self.size - len(drop) > self.minSize)
+                if expired or not session.isAlive():
+                    drop.append(session)
+                else:
+                    keep.append((session, since))
+            self.idle = keep
+            self.size -= len(drop)
+            if drop:
+                self.cond.notify_all()
+        for session in drop:
+            await session.close()
+        await self.fill()
+
+    async def maintain(self):
+        while True:
+            await asyncio.sleep(self.checkInterval)
+            try:
+                await self.check()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # also malformed gateway frames: keep maintaining the pool
+                LOGGER.exception("pool check for %s:", self.host)
+
+
+Device = collections.namedtuple('Device', 'who where frames')
+
+def lockWheres(devs=range(1, 10), addrs=range(10)):
+    """WHERE of WHO=8 door locks: device dev followed by device addr ('20', '21', ...)."""
+    return ['%d%d' % (dev, addr) for dev in devs for addr in addrs]
+
+async def scan(pool, whos, wheres, timeout=2.0, workers=None, acked=False):
+    """
+    Send the status request '*#WHO*WHERE##' of every WHO for every WHERE
+    and return the Device list of the addresses that answered with status
+    frames (acked=True: also those with a bare ACK), sorted by WHO/WHERE.
+    Up to workers (default pool.maxSize) sessions of pool run at once,
+    each with a full window of probes in flight. A session with an
+    unanswered probe is out of step and goes back to the pool discarded;
+    the worker goes on with a fresh one. The replies of such a batch may
+    belong to earlier probes, so its probes are sent again one at a time.
+    """
+    probes = iter([(str(who), str(where)) for who in whos for where in wheres])
+    retry = collections.deque()     # probes of a batch that lost a reply
+    found = []
+
+    async def work():
+        while True:
+            session = await pool.acquire()
+            discard = True
+            try:
+                while True:
+                    if retry:
+                        batch = [retry.popleft()]
+                    else:
+                        batch = [p for (_, p) in zip(range(session.window), probes)]
+                    if not batch:
+                        discard = False
+                        return
+                    futures = [await session.submit('*#%s*%s##' % p, timeout) for p in batch]
+                    replies = await asyncio.gather(*futures, return_exceptions=True)
+                    lost = any(isinstance(reply, Exception) for reply in replies)
+                    if lost and len(batch) > 1:
+                        retry.extend(batch)
+                        break
+                    for (who, where), reply in zip(batch, replies):
+                        if isinstance(reply, Exception):
+                            LOGGER.debug("no reply for WHO=%s WHERE=%s: %r", who, where, reply)
+                        elif reply.ok and (reply.frames or acked):
+                            found.append(Device(who, where, reply.frames))
+                    if lost:
+                        break
+            finally:
+                await pool.release(session, discard)
+
+    await asyncio.gather(*(work() for _ in range(workers or pool.maxSize)))
+    found.sort(key=lambda d: (int(d.who), len(d.where), d.where))
+    return found
+
+# answerChallenge() digit -> ('rot', left rotation) / ('perm', source byte of
+# result bytes 0..3, least significant first) / ('not', None)
+CHALLENGE_OPS = {
+    '1': ('rot', 25),
+    '2': ('rot', 28),
+    '3': ('rot', 29),
+    '4': ('rot', 1),
+    '5': ('rot', 5),
+    '6': ('rot', 12),
+    '7': ('perm', (2, 1, 3, 0)),
+    '8': ('perm', (3, 2, 0, 1)),
+    '9': ('not', None),
+}
+
+class ChallengeEngine():
+    """
+    Compiled form of Bticino.answerChallenge().
+
+    Every nonce digit is a 32-bit rotation, a byte permutation or a bitwise
+    NOT, so a whole nonce folds into a short list of rotations and byte
+    permutations plus one final inversion. compile() turns that into a
+    Python function (cached per nonce); batch() evaluates many
+    (password, nonce) pairs on NumPy uint32 arrays when NumPy is installed.
+    """
+
+    def __init__(self, cacheSize=4096):
+        self.compile = functools.lru_cache(maxsize=cacheSize)(self.compileNonce)
+
+    @staticmethod
+    def program(nonce):
+        """Fold a nonce into ([(op, arg), ...], invert)."""
+        ops = []
+        invert = False
+        for c in nonce:
+            op = CHALLENGE_OPS.get(c)
+            if op is None:
+                continue
+            kind, arg = op
+            if kind == 'not':
+                invert = not invert     # NOT commutes with bit permutations
+                continue
+            if kind == 'rot' and arg % 8 == 0:
+                kind, arg = 'perm', tuple((k - arg // 8) % 4 for k in range(4))
+            if ops and ops[-1][0] == kind:
+                prev = ops.pop()[1]
+                if kind == 'rot':
+                    arg = (prev + arg) % 32
+                else:
+                    arg = tuple(prev[arg[k]] for k in range(4))
+            if arg not in (0, (0, 1, 2, 3)):
+                ops.append((kind, arg))
+        return ops, invert
+
+    @classmethod
+    def source(cls, nonce):
+        ops, invert = cls.program(nonce)
+        lines = ["def answer(x):", "    x &= 0xFFFFFFFF"]
+        for kind, arg in ops:
+            if kind == 'rot':
+                lines.append("    x = ((x << %d) | (x >> %d)) & 0xFFFFFFFF" % (arg, 32 - arg))
+            else:
+                lanes = ["((x >> %d) & 0xFF) << %d" % (8 * src, 8 * dst)
+                         for dst, src in enumerate(arg)]
+                lines.append("    x = " + " | ".join(lanes))
+        lines.append("    return x ^ 0xFFFFFFFF" if invert else "    return x")
+        return "\n".join(lines)
+
+    def compileNonce(self, nonce):
+        if not nonce:
+            return lambda x: 0      # answerChallenge() answers 0
+        namespace = {}
+        exec(self.source(nonce), namespace)
+        return namespace['answer']
+
+    def invert(self, nonce, answer):
+        """
+        The password, modulo 2**32, whose answer to nonce is answer: every
+        step of the program is a bijection, so it runs backwards.
+        """
+        if not nonce:
+            raise ValueError("an empty nonce is answered 0 whatever the password")
+        ops, invert = self.program(nonce)
+        x = int(answer) & 0xFFFFFFFF
+        if invert:
+            x ^= 0xFFFFFFFF
+        for kind, arg in reversed(ops):
+            if kind == 'rot':
+                x = ((x >> arg) | (x << (32 - arg))) & 0xFFFFFFFF
+            else:
+                x = sum(((x >> 8 * dst) & 0xFF) << 8 * src for dst, src in enumerate(arg))
+        return x
+
+    def answer(self, frame, password):
+        """Drop-in for Bticino.answerChallenge(): frame is '*#<nonce>'."""
+        return str(self.compile(frame[2:])(int(password)))
+
+    def batch(self, passwords, nonces):
+        """
+        Answers for the pairs (passwords[i], nonces[i]); a single nonce
+        string is applied to every password. Returns a list of ints, or a
+        uint32 array when NumPy is available.
+        """
+        if isinstance(nonces, str):
+            nonces = [nonces] * len(passwords)
+        if numpy is None:
+            return [self.compile(n)(int(p)) for (p, n) in zip(passwords, nonces)]
+        values = numpy.asarray(passwords, dtype=numpy.int64).astype('<u4')
+        result = numpy.zeros(len(values), dtype='<u4')
+        groups = {}
+        for i, nonce in enumerate(nonces):
+            groups.setdefault(nonce, []).append(i)
+        for nonce, index in groups.items():
+            if nonce:
+                index = numpy.asarray(index)
+                result[index] = self.evaluate(nonce, values[index])
+        return result
+
+    def evaluate(self, nonce, x):
+        """Apply the program of one nonce to a uint32 array."""
+        ops, invert = self.program(nonce)
+        for kind, arg in ops:
+            if kind == 'rot':
+                x = (x << numpy.uint32(arg)) | (x >> numpy.uint32(32 - arg))
+            else:
+                x = numpy.ascontiguousarray(x.view(numpy.uint8).reshape(-1, 4)[:, arg]).view('<u4').ravel()
+        if invert:
+            x = ~x
+        return x
+
+
+class ScheduledCommand():
+    __slots__ = ('frame', 'priority', 'future', 'started')
+
+    def __init__(self, frame, priority, future):
+        self.frame = frame
+        self.priority = priority
+        self.future = future
+        self.started = False
+
+class CommandScheduler():
+    """
+    Priority queue in front of a Bticino or SessionPool (anything with a
+    request() coroutine). Lock actions run before state changes, which run
+    before diagnostic queries. Identical commands still waiting are merged
+    into one execution whose Reply goes to every caller, and an optional
+    token bucket limits the commands per second sent to the gateway.
+    """
+
+    def __init__(self, target, workers=1, rate=None, burst=1):
+        self.target = target
+        self.workers = workers
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.queue = None
+        self.waiting = {}       # frame -> ScheduledCommand not started yet
+        self.tasks = []
+        self.seq = 0
+        self.stats = collections.Counter()
+
+    @staticmethod
+    def classify(frame):
+        try:
+            msg = parseFrame(frame)
+        except ExBadFrame:
+            return PRIORITY_STATE
+        if msg.kind == MSG_STANDARD and msg.who == 8 and msg.what in LOCK_WHATS:
+            return PRIORITY_LOCK
+        if msg.kind in (MSG_STATUS_REQUEST, MSG_DIMENSION_REQUEST):
+            return PRIORITY_DIAGNOSTIC
+        return PRIORITY_STATE
+
+    def start(self):
+        self.queue = asyncio.PriorityQueue()
+        self.tasks = [asyncio.ensure_future(self.work()) for _ in range(self.workers)]
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        for cmd in self.waiting.values():
+            if not cmd.future.done():
+                cmd.future.cancel()
+        self.waiting.clear()
+
+    def submit(self, frame, priority=None):
+        """Queue a command, or join the identical one still waiting."""
+        if priority is None:
+            priority = self.classify(frame)
+        cmd = self.waiting.get(frame)
+        if cmd is None:
+            cmd = ScheduledCommand(frame, priority,
+                                   asyncio.get_running_loop().create_future())
+            self.waiting[frame] = cmd
+            self.push(cmd)
+        else:
+            self.stats['coalesced'] += 1
+            if priority < cmd.priority:
+                cmd.priority = priority
+                self.push(cmd)  # the old queue entry is skipped as stale
+        return cmd.future
+
+    async def request(self, frame, priority=None):
+        return await asyncio.shield(self.submit(frame, priority))
+
+    def push(self, cmd):
+        self.seq += 1
+        self.queue.put_nowait((cmd.priority, self.seq, cmd))
+
+    async def throttle(self):
+        if not self.rate:
+            return
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    async def work(self):
+        while True:
+            await self.throttle()
+            while True:
+                priority, _, cmd = await self.queue.get()
+                if not cmd.started and priority == cmd.priority:
+                    break
+            cmd.started = True
+            del self.waiting[cmd.frame]
+            self.stats['executed'] += 1
+            try:
+                reply = await self.target.request(cmd.frame)
+            except asyncio.CancelledError:
+                cmd.future.cancel()
+                raise
+            except Exception as e:
+                if not cmd.future.done():
+                    cmd.future.set_exception(e)
+            else:
+                if not cmd.future.done():
+                    cmd.future.set_result(reply)
+
+class Gateway():
+    """Sessions of one gateway run by a GatewayManager."""
+
+    def __init__(self, id, host, port=20000, password=710299916, minSize=1, maxSize=2):
+        self.id = id
+        self.pool = SessionPool(host, port, password, minSize, maxSize)
+        self.monitor = Bticino(MONITOR, host, port, password)
+        self.supervisor = None
+        self.metrics = Metrics({'gateway': id})
+        self.pool.metrics = self.metrics
+        self.metrics.attach(self.monitor)
+
+    def health(self):
+        monitor = self.monitor
+        return {
+            'host': monitor.host,
+            'monitor': monitor.running and monitor.isAlive(),
+            'connects': monitor.stats['connects'],
+            'reconnects': monitor.stats['reconnects'],
+            'downtime': monitor.stats['downtime'],
+            'lastError': monitor.stats['lastError'],
+            'sessions': self.pool.size,
+            'idle': len(self.pool.idle),
+        }
+
+class GatewayManager():
+    """
+    Monitor and command sessions of many gateways on one event loop.
+
+    gateways is a list of dicts with the Gateway arguments (id, host,
+    port, password, minSize, maxSize). Monitor frames of every gateway
+    reach one EventBus as (gateway id, frame) tuples, and at most
+    maxHandshakes connect+handshake sequences run at the same time.
+    A BLOCK subscriber that falls behind holds back the monitor sessions
+    of all gateways.
+    """
+
+    def __init__(self, gateways, maxHandshakes=4):
+        self.configs = list(gateways)
+        self.maxHandshakes = maxHandshakes
+        self.gateways = {}
+        self.bus = EventBus(lambda item: item[1])   # items: (gateway id, frame)
+
+    async def start(self):
+        handshakes = asyncio.Semaphore(self.maxHandshakes)
+        for config in self.configs:
+            gateway = Gateway(**config)
+            if gateway.id in self.gateways:
+                raise ValueError("duplicate gateway id '%s'" % gateway.id)
+            self.gateways[gateway.id] = gateway
+            gateway.pool.handshakes = handshakes
+            gateway.monitor.handshakes = handshakes
+            gateway.monitor.addListener(functools.partial(self.publish, gateway.id))
+            gateway.monitor.buses.append(self.bus)
+            gateway.supervisor = asyncio.ensure_future(gateway.monitor.supervise())
+        results = await asyncio.gather(*(g.pool.start() for g in self.gateways.values()),
+                                       return_exceptions=True)
+        for gateway, result in zip(self.gateways.values(), results):
+            if isinstance(result, Exception):
+                LOGGER.warning("gateway %s: no command session yet (%r)", gateway.id, result)
+
+    def publish(self, gatewayId, frame):
+        self.bus.publish((gatewayId, frame))
+
+    def subscribe(self, maxsize=1000, policy=DROP_OLDEST, who=None, what=None, where=None):
+        """Queue of (gateway id, frame) of all monitor sessions."""
+        return self.bus.subscribe(maxsize, policy, who, what, where)
+
+    async def request(self, gatewayId, frame, timeout=REQUEST_TIMEOUT):
+        return await self.gateways[gatewayId].pool.request(frame, timeout)
+
+    async def query(self, gatewayId, frame, ttl=None):
+        return await self.gateways[gatewayId].pool.query(frame, ttl)
+
+    async def unlock(self, gatewayId, where='20', hold=1.0):
+        return await self.gateways[gatewayId].pool.unlock(where, hold)
+
+    def health(self):
+        return {gid: gateway.health() for (gid, gateway) in self.gateways.items()}
+
+    def metrics(self):
+        return {gid: gateway.metrics.snapshot() for (gid, gateway) in self.gateways.items()}
+
+    async def close(self):
+        for gateway in self.gateways.values():
+            gateway.monitor.stop()
+        await asyncio.gather(*(g.supervisor for g in self.gateways.values() if g.supervisor),
+                             *(g.pool.close() for g in self.gateways.values()),
+                             return_exceptions=True)
+
+class BticinoSync():
+    """
+    Blocking, thread-safe facade for threaded code such as Flask handlers
+    or paho callbacks. A daemon thread runs one event loop owning a
+    SessionPool of command sessions and, from the first subscribe(), a
+    supervised MONITOR session. With wait=False the methods return a
+    concurrent.futures.Future instead of blocking.
+    """
+
+    def __init__(self, host='localhost', port=20000, password=710299916,
+                 minSize=1, maxSize=4, timeout=30.0):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self.pool = None
+        self.monitor = None
+        self.supervisor = None
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       name='bticino-%s' % host, daemon=True)
+        self.thread.start()
+        try:
+            self.call(self.setup(minSize, maxSize))
+        except BaseException:
+            if self.pool:
+                asyncio.run_coroutine_threadsafe(self.pool.close(), self.loop).result()
+            self.stopLoop()
+            raise
+
+    async def setup(self, minSize, maxSize):
+        # asyncio objects are created on the loop thread
+        self.pool = SessionPool(self.host, self.port, self.password, minSize, maxSize)
+        await self.pool.start()
+
+    def call(self, coro, wait=True):
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        if not wait:
+            return future
+        return future.result(self.timeout)
+
+    def request(self, frame, wait=True):
+        return self.call(self.pool.request(frame), wait)
+
+    def query(self, frame, ttl=None, wait=True):
+        return self.call(self.pool.query(frame, ttl), wait)
+
+    def unlock(self, where='20', hold=1.0, wait=True):
+        return self.call(self.pool.unlock(where, hold), wait)
+
+    def voicemail(self, enable, wait=True):
+        return self.call(self.withSession(lambda s: s.voicemail(enable)), wait)
+
+    async def withSession(self, func):
+        async with self.pool.session() as session:
+            return await func(session)
+
+    def subscribe(self, callback):
+        """
+        Call callback(frame) for every monitor frame. It runs on the loop
+        thread, so it must be quick and hand work over to its own thread.
+        """
+        self.loop.call_soon_threadsafe(self.attach, callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        self.loop.call_soon_threadsafe(self.detach, callback)
+
+    def attach(self, callback):
+        if self.monitor is None:
+            self.monitor = Bticino(MONITOR, self.host, self.port, self.password)
+            self.supervisor = asyncio.ensure_future(self.monitor.supervise())
+        self.monitor.addListener(callback)
+
+    def detach(self, callback):
+        if self.monitor and callback in self.monitor.listeners:
+            self.monitor.removeListener(callback)
+
+    async def shutdown(self):
+        if self.monitor:
+            self.monitor.stop()
+            # do not wait for a handshake or backoff in progress
+            self.supervisor.cancel()
+            with contextlib.suppress(asyncio.CancelledError, Exception):
+                await self.supervisor
+            await self.monitor.close()
+        if self.pool:
+            await self.pool.close()
+
+    def close(self):
+        if self.loop.is_running():
+            try:
+                self.call(self.shutdown())
+            finally:
+                self.stopLoop()
+
+    def stopLoop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def parseScript(lines):
+    """
+    Batch script lines: 'FRAME [SECONDS]' waits SECONDS after FRAME has
+    been answered; blank lines and '#' comments are skipped. Returns
+    batches of (line number, frame), each followed by its delay: the
+    frames of a batch have no delay between them.
+    """
+    batches, batch = [], []
+    for lineno, line in enumerate(lines, 1):
+        fields = line.split()
+        if not fields or fields[0].startswith('#'):
+            continue
+        frame = fields[0]
+        if not (frame.startswith('*') and frame.endswith('##')) or len(fields) > 2:
+            raise ValueError("line %d: expected 'FRAME [SECONDS]': %r" % (lineno, line.strip()))
+        parseFrame(frame)
+        batch.append((lineno, frame))
+        delay = float(fields[1]) if len(fields) > 1 else 0.0
+        if delay:
+            batches.append((batch, delay))
+            batch = []
+    if batch:
+        batches.append((batch, 0.0))
+    return batches
+
+async def runCommand(pool, gateway, lineno, frame, timeout):
+    began = time.monotonic()
+    result = {'gateway': gateway, 'line': lineno, 'frame': frame}
+    try:
+        reply = await pool.request(frame, timeout)
+        result.update(ok=reply.ok, reply=[f.decode(errors='replace') for f in reply.frames])
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        # also malformed gateway frames or a closed pool: one failed result
+        result.update(ok=False, error=repr(e))
+    result['ms'] = round(1e3 * (time.monotonic() - began), 3)
+    return result
+
+async def runBatch(gateways, batches, password=710299916, sessions=2, timeout=REQUEST_TIMEOUT,
+                   maxHandshakes=4, output=print, parallel=False):
+    """
+    Run the parseScript() batches against every gateway ('host' or
+    'host:port') at once, over a SessionPool each, calling output() with
+    one result dict per command. Returns the number of failed commands.
+    The lines of one gateway run in script order, each after the reply to
+    the previous one; parallel=True sends the frames of a batch at once
+    over the pool sessions, in no particular order.
+    """
+    handshakes = asyncio.Semaphore(maxHandshakes)
+    failed = 0
+
+    async def run(gateway):
+        nonlocal failed
+        host, _, port = gateway.partition(':')
+        pool = SessionPool(host, int(port or 20000), password, minSize=1, maxSize=sessions)
+        pool.handshakes = handshakes
+        try:
+            await pool.start()
+            for batch, delay in batches:
+                if parallel:
+                    results = await asyncio.gather(
+                        *(runCommand(pool, gateway, n, f, timeout) for (n, f) in batch))
+                else:
+                    results = [await runCommand(pool, gateway, n, f, timeout) for (n, f) in batch]
+                for result in results:
+                    failed += not result['ok']
+                    output(result)
+                if delay:
+                    await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            failed += sum(len(batch) for (batch, _) in batches)
+            output({'gateway': gateway, 'ok': False, 'error': repr(e)})
+        finally:
+            await pool.close()
+
+    await asyncio.gather(*(run(g) for g in gateways))
+    return failed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m bticino',
+        description="Run a script of OpenWebNet frames ('FRAME [SECONDS]' per line) "
+                    "against one or many gateways, printing one JSON result per command.")
+    parser.add_argument('script', nargs='?', default='-', type=argparse.FileType(encoding='utf-8'),
+                        help="script file, '-': stdin")
+    parser.add_argument('-g', '--gateway', action='append', required=True,
+                        help='host[:port], repeatable')
+    parser.add_argument('-p', '--password', type=int, default=710299916)
+    parser.add_argument('--sessions', type=int, default=2, help='sessions per gateway')
+    parser.add_argument('--timeout', type=float, default=REQUEST_TIMEOUT,
+                        help='seconds per command')
+    parser.add_argument('--handshakes', type=int, default=4,
+                        help='concurrent handshakes over all gateways')
+    parser.add_argument('--parallel', action='store_true',
+                        help='send the lines with no delay between them concurrently, in no set order')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    LOGGER.setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+
+    try:
+        with args.script:
+            batches = parseScript(args.script.read().splitlines())
+    except (OSError, ValueError, ExBadFrame) as e:
+        parser.error(str(e))
+
+    began = time.monotonic()
+    output = lambda result: print(json.dumps(result), flush=True)
+    failed = asyncio.run(runBatch(args.gateway, batches, args.password, args.sessions,
+                                  args.timeout, args.handshakes, output, args.parallel))
+    commands = len(args.gateway) * sum(len(batch) for (batch, _) in batches)
+    print("%d commands on %d gateways, %d failed, %.2fs" % (
+        commands, len(args.gateway), failed, time.monotonic() - began), file=sys.stderr)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Recover the OPEN password of your own unit from captured numeric handshakes.
+
+The gateway sends a nonce '*#<nonce>##' and the client answers
+'*#<answer>##' (Bticino.answerChallenge(), ownCalcPass() of
+bticino_bridge/docs/calc_passwd.py). Each nonce digit is a 32-bit
+rotation, byte permutation or NOT, all bijections, so
+ChallengeEngine.invert() runs the nonce backwards and one pair gives the
+password modulo 2**32 at once: no search over the password space.
+Further pairs must agree, which tells whether they come from the same
+password. Longer passwords are listed as the values up to --digits digits
+with the same low 32 bits.
+
+    python bticino_passwd.py 603356072:25280520 410501656:119537670
+    python bticino_passwd.py --log session.owl
+"""
+
+import sys
+import argparse
+
+import bticino
+
+
+def logPairs(path):
+    """(nonce, answer) of the numeric handshakes in a SessionRecorder log."""
+    nonce = None
+    for _, direction, frame in bticino.readLog(path):
+        text = frame.decode('ascii', errors='replace')
+        numeric = text.startswith('*#') and text.endswith('##') and text[2:-2].isdigit()
+        if direction == bticino.DIR_RX:
+            nonce = text[2:-2] if numeric else None
+        elif direction == bticino.DIR_TX:
+            if nonce and numeric:
+                yield nonce, text[2:-2]
+            nonce = None
+
+
+def parsePair(text):
+    nonce, sep, answer = text.partition(':')
+    if not sep or not nonce.isdigit() or not answer.isdigit():
+        raise argparse.ArgumentTypeError("expected NONCE:ANSWER, got %r" % text)
+    return nonce, answer
+
+
+def recover(pairs, digits=10, engine=None):
+    """
+    Password candidates matching every (nonce, answer) pair, smallest
+    first, or [] when the pairs disagree.
+    """
+    engine = engine or bticino.ChallengeEngine()
+    values = {engine.invert(nonce, answer) for (nonce, answer) in pairs}
+    if len(values) != 1:
+        return []
+    low = values.pop()
+    return [password for password in range(low, 10 ** digits, 2 ** 32)
+            if all(engine.answer('*#' + n, password) == str(int(a)) for (n, a) in pairs)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('pairs', nargs='*', type=parsePair, metavar='NONCE:ANSWER')
+    parser.add_argument('--log', action='append', default=[],
+                        help='session log written by bticino.SessionRecorder, repeatable')
+    parser.add_argument('--digits', type=int, default=10,
+                        help='longest password considered, in digits')
+    args = parser.parse_args()
+
+    pairs = list(args.pairs)
+    for path in args.log:
+        pairs.extend(logPairs(path))
+    if not pairs:
+        parser.error('no nonce/answer pair given or found in the logs')
+
+    engine = bticino.ChallengeEngine()
+    for nonce, answer in pairs:
+        print('nonce %s answer %s -> password mod 2**32 = %d' % (
+            nonce, answer, engine.invert(nonce, answer)))
+    candidates = recover(pairs, args.digits, engine)
+    if not candidates:
+        print('the pairs disagree: they do not come from one password', file=sys.stderr)
+        sys.exit(1)
+    print('password: %s' % ' or '.join(str(c) for c in candidates))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Local stand-in for the intercom OpenWebNet server.
+
+Port 20000 speaks the authenticated protocol used by bticino.Bticino
+(ACK, session mode, then the numeric answerChallenge() scheme, the '*98*2'
+HMAC scheme or no authentication). Port 30006 is the plain local port used
+by the ha_config send_data() helpers: every frame is answered directly.
+Commands get ACK/NACK and the documented dimension replies, and are
+echoed to MONITOR sessions together with scripted events.
+
+    python bticino_sim.py --auth hmac --password 12345 --latency 0.02 --jitter 0.01
+"""
+
+import time
+import random
+import hashlib
+import logging
+import asyncio
+import argparse
+import collections
+
+import bticino
+
+LOGGER = logging.getLogger(__name__)
+
+AUTH_NONE = 'none'
+AUTH_NUMERIC = 'numeric'
+AUTH_HMAC = 'hmac'
+
+# static dimension replies taken from the bticino.py protocol notes
+DIMENSIONS = {
+    '*#1013**1##': '*#1013**1*68*15*1*0##',
+    '*#1013**2##': '*#1013**2*1*1*41##',
+    '*#1013**3##': '*#1013**3*0*0*0##',
+    '*#1013**6##': '*#1013**6*1*0*0##',
+    '*#13**10##': '*#13**10*192*168*111*4##',
+    '*#13**11##': '*#13**11*255*255*255*0##',
+    '*#13**15##': '*#13**15*200##',
+}
+
+# (WHO, WHERE) -> status frames: the locks of the bticino.py database excerpt
+DEVICES = {
+    (8, '20'): ['*8*20*20##'],
+    (8, '21'): ['*8*20*21##'],
+    (8, '23'): ['*8*20*23##'],
+}
+
+
+class SimSession():
+    """One client connection; replies leave in order after the simulated delay."""
+
+    def __init__(self, sim, reader, writer, raw):
+        self.sim = sim
+        self.reader = reader
+        self.writer = writer
+        self.raw = raw
+        self.mode = None
+        self.outbox = asyncio.Queue()
+        self.lastDue = 0.0
+
+    def send(self, *frames, delay=True):
+        now = time.monotonic()
+        due = now + self.sim.delay() if delay else now
+        self.lastDue = due = max(due, self.lastDue)
+        for frame in frames:
+            self.outbox.put_nowait((due, frame.encode() if isinstance(frame, str) else frame))
+
+    async def flush(self):
+        while True:
+            due, data = await self.outbox.get()
+            wait = due - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self.writer.write(data)
+            if self.outbox.empty():
+                await self.writer.drain()
+            self.outbox.task_done()
+
+    async def frames(self, decoder):
+        while True:
+            data = await self.reader.read(bticino.READ_SIZE)
+            if not data:
+                return
+            for frame in decoder.feed(data):
+                yield frame.decode('ascii', errors='replace')
+
+    async def run(self):
+        flusher = asyncio.ensure_future(self.flush())
+        try:
+            if self.raw:
+                await self.serveCommands(bticino.FrameDecoder())
+            else:
+                await self.serve()
+        except (ConnectionError, StopAsyncIteration) as e:
+            LOGGER.debug("session ended: %r", e)
+        finally:
+            # let queued replies go out before closing
+            try:
+                await asyncio.wait_for(self.outbox.join(), 1.0 + self.sim.latency + self.sim.jitter)
+            except (asyncio.TimeoutError, ConnectionError):
+                pass
+            flusher.cancel()
+            self.sim.monitors.discard(self)
+            self.writer.close()
+
+    async def serve(self):
+        decoder = bticino.FrameDecoder()
+        frames = self.frames(decoder)
+        self.send(bticino.ACK_FRAME, delay=False)
+        mode = await frames.__anext__()
+        if mode not in (bticino.MONITOR, bticino.COMMANDS, bticino.SPECIAL):
+            self.send(bticino.NACK_FRAME)
+            return
+        self.mode = mode
+        if not await self.sim.authenticate(self, frames):
+            self.sim.stats['failedHandshakes'] += 1
+            self.send(bticino.NACK_FRAME)
+            return
+        self.sim.stats['handshakes'] += 1
+        if mode == bticino.MONITOR:
+            self.sim.monitors.add(self)
+            async for frame in frames:
+                # status requests are answered on a monitor too, commands ignored
+                try:
+                    kind = bticino.parseFrame(frame).kind
+                except bticino.ExBadFrame:
+                    continue
+                if kind in (bticino.MSG_STATUS_REQUEST, bticino.MSG_DIMENSION_REQUEST):
+                    self.send(*self.sim.reply(frame))
+        else:
+            await self.serveCommands(decoder, frames)
+
+    async def serveCommands(self, decoder, frames=None):
+        if frames is None:
+            frames = self.frames(decoder)
+        async for frame in frames:
+            self.sim.stats['commands'] += 1
+            self.send(*self.sim.reply(frame))
+
+
+class GatewaySimulator():
+    """
+    Simulated gateway: password and auth scheme of port 20000, a fixed
+    latency plus uniform jitter before every reply, and emit()/play()/
+    generate() to push events to MONITOR sessions.
+    """
+
+    def __init__(self, host='127.0.0.1', port=20000, rawPort=30006,
+                 password=710299916, auth=AUTH_NUMERIC, latency=0.0, jitter=0.0):
+        self.host = host
+        self.port = port
+        self.rawPort = rawPort
+        self.password = password
+        self.auth = auth
+        self.latency = latency
+        self.jitter = jitter
+        self.dimensions = dict(DIMENSIONS)
+        self.devices = dict(DEVICES)
+        self.nack = set()           # frames always answered with NACK
+        self.silent = set()         # frames never answered
+        self.monitors = set()
+        self.servers = []
+        self.tasks = set()          # one per client connection
+        self.engine = bticino.ChallengeEngine()
+        self.handshake = bticino.HmacHandshake(password)
+        self.pwdDigest = hashlib.sha256(str(password).encode()).hexdigest()
+        self.stats = collections.Counter()
+
+    def delay(self):
+        return self.latency + random.uniform(0, self.jitter)
+
+    async def start(self):
+        self.servers.append(await asyncio.start_server(
+            lambda r, w: self.accept(r, w, False), self.host, self.port))
+        if self.rawPort is not None:
+            self.servers.append(await asyncio.start_server(
+                lambda r, w: self.accept(r, w, True), self.host, self.rawPort))
+        # port 0 picks a free port: report the real ones
+        self.port = self.servers[0].sockets[0].getsockname()[1]
+        if self.rawPort is not None:
+            self.rawPort = self.servers[1].sockets[0].getsockname()[1]
+        LOGGER.info("simulating gateway on %s:%d (raw %s), auth=%s",
+                    self.host, self.port, self.rawPort, self.auth)
+
+    async def close(self):
+        for server in self.servers:
+            server.close()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        for server in self.servers:
+            await server.wait_closed()
+        self.servers = []
+
+    async def accept(self, reader, writer, raw):
+        self.stats['connections'] += 1
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        try:
+            await SimSession(self, reader, writer, raw).run()
+        except asyncio.CancelledError:
+            writer.close()
+        finally:
+            self.tasks.discard(task)
+
+    async def authenticate(self, session, frames):
+        if self.auth == AUTH_NONE:
+            session.send(bticino.ACK_FRAME)
+            return True
+        if self.auth == AUTH_NUMERIC:
+            nonce = '%09d' % random.randrange(10 ** 9)
+            session.send('*#%s##' % nonce)
+            answer = await frames.__anext__()
+            if answer != '*#%s##' % self.engine.answer('*#' + nonce, self.password):
+                return False
+            session.send(bticino.ACK_FRAME)
+            return True
+        session.send('*98*2##')
+        if await frames.__anext__() != '*#*1##':
+            return False
+        ra = bticino.bytes2nums(random.getrandbits(256).to_bytes(32, 'big'))
+        session.send('*#%s##' % ra)
+        answer = await frames.__anext__()
+        try:
+            rb, hmac = answer[2:-2].split('*')
+        except ValueError:
+            return False
+        if hmac != self.handshake.answer('*#' + ra, rb)[1]:
+            return False
+        raHex, rbHex = bticino.nums2hex(ra), bticino.nums2hex(rb)
+        digest = hashlib.sha256((raHex + rbHex + self.pwdDigest).encode())
+        session.send('*#%s##' % bticino.bytes2nums(digest.digest()))
+        return await frames.__anext__() == '*#*1##'
+
+    def dimension(self, frame):
+        if frame == '*#13**0##':
+            return time.strftime('*#13**0*%H*%M*%S*999##')
+        if frame == '*#13**1##':
+            return time.strftime('*#13**1*%w*%d*%m*%Y##')
+        return self.dimensions.get(frame)
+
+    def reply(self, frame):
+        """Frames answering one command, events are echoed to monitors."""
+        if frame in self.silent:
+            return []
+        if frame in self.nack:
+            return [bticino.NACK_FRAME]
+        try:
+            msg = bticino.parseFrame(frame)
+        except bticino.ExBadFrame:
+            return [bticino.NACK_FRAME]
+        if msg.kind == bticino.MSG_DIMENSION_REQUEST:
+            value = self.dimension(frame)
+            if value is None:
+                return [bticino.NACK_FRAME]
+            return [value, bticino.ACK_FRAME]
+        if msg.kind == bticino.MSG_STATUS_REQUEST:
+            status = self.devices.get((msg.who, msg.where))
+            if status is None:
+                return [bticino.NACK_FRAME]
+            return status + [bticino.ACK_FRAME]
+        if msg.kind in (bticino.MSG_ACK, bticino.MSG_NACK):
+            return [bticino.ACK_FRAME]
+        self.emit(frame)
+        return [bticino.ACK_FRAME]
+
+    def emit(self, frame):
+        """Send one event frame to every MONITOR session."""
+        self.stats['events'] += 1
+        for session in self.monitors:
+            session.send(frame)
+
+    async def play(self, script):
+        """script: iterable of (seconds to wait, frame)."""
+        for wait, frame in script:
+            if wait:
+                await asyncio.sleep(wait)
+            self.emit(frame)
+
+    async def generate(self, frames, rate=10.0, count=None, burst=1):
+        """Emit frames round-robin at 'rate' bursts per second."""
+        sent = 0
+        frames = list(frames)
+        while count is None or sent < count:
+            for _ in range(burst):
+                self.emit(frames[sent % len(frames)])
+                sent += 1
+            await asyncio.sleep(1.0 / rate)
+
+
+async def main(args):
+    sim = GatewaySimulator(args.host, args.port, args.raw_port, args.password,
+                           args.auth, args.latency, args.jitter)
+    await sim.start()
+    try:
+        if args.events:
+            await sim.generate(args.event, args.events, burst=args.burst)
+        else:
+            await asyncio.Event().wait()
+    finally:
+        await sim.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='OpenWebNet gateway simulator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=20000)
+    parser.add_argument('--raw-port', type=int, default=30006)
+    parser.add_argument('--password', type=int, default=710299916)
+    parser.add_argument('--auth', choices=(AUTH_NONE, AUTH_NUMERIC, AUTH_HMAC),
+                        default=AUTH_NUMERIC)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds before every reply')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='extra uniform random delay, seconds')
+    parser.add_argument('--events', type=float, default=0.0,
+                        help='monitor event bursts per second (0: none)')
+    parser.add_argument('--burst', type=int, default=1)
+    parser.add_argument('--event', action='append',
+                        default=None, help='event frame, repeatable')
+    args = parser.parse_args()
+    if not args.event:
+        args.event = ['*8*1#1#4#21*16##', '*8*19*20##', '*8*20*20##',
+                      '*7*73#1#100*##', '*7*73#1#10*##']
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(main(args))
+    except KeyboardInterrupt:
+        pass
@@ -19,6 +19,11 @@ import ipaddress
 import configparser
 import threading
 import signal
+import selectors
+import struct
+import ctypes
+import mmap
+import re
 # NOTE: Better is using lxml but difficult to install inside Bticino-Legrand
 from xml.etree import ElementTree
 # from lxml import html, etree
@@ -66,121 +71,94 @@ class EventHandler(pyinotify.ProcessEvent):
         self.logger.info('GPIO or LED: ' + event.pathname + ' = ' + value)
 
 
-class GPIOLEDsDetectionThread(threading.Thread):
-    """Class of GPIO and LEDs detection thread."""
-    def __init__(self, logger, client, event):
-        super().__init__()
-        self.logger = logger
-        self.client = client
-        self.stop_event = event
-
-    def stop(self):
-        """Stop thread."""
-        self.stop_event.set()
-        self.logger.info('Thread keydetection stopped')
-
-    def run(self):
-        """Thread for key detection."""
-        self.logger.info('Thread keydetection started')
-        led_symlink_pattern = '/sys/class/leds/*/brightness'
-        gpio_file_pattern = '/sys/class/gpio/*/value'
-
-        # Initialize an inotify watcher
-        wm = pyinotify.WatchManager()
-
-        # Define the events you want to watch for (symbolic link modification)
-        mask = pyinotify.IN_MODIFY
-
-        # Initialize the notifier
-        notifier = pyinotify.Notifier(wm, EventHandler(self.logger, self.client))
-
-        # Add watches for symbolic links and files matching the patterns
-        for symlink_path in glob.glob(led_symlink_pattern):
-            wdd = wm.add_watch(symlink_path, mask)
-        for gpio_file_path in glob.glob(gpio_file_pattern):
-            wdd = wm.add_watch(gpio_file_path, mask)
-        if wdd:
-            # Start the notifier loop to watch for changes
-            notifier.loop()
-
-
-class KeyDetectionThread(threading.Thread):
-    """Class of key detection thread."""
-    def __init__(self, logger, selector, client, event):
-        super().__init__()
-        self.logger = logger
-        self.selector = selector
-        self.client = client
-        self.stop_event = event
-
-    def stop(self):
-        """Stop thread."""
-        self.stop_event.set()
-        self.logger.info('Thread keydetection stopped')
-
-    def run(self):
-        """Thread for key detection."""
-        self.logger.info('Thread keydetection started')
-        selector = self.selector
-        client = self.client
-        while not self.stop_event.is_set():
-            key_used = None
-            selectors = selector.select(timeout=0.1)
-            for key, mask in selectors:
-                device = key.fileobj
-                if self.stop_event.is_set():
-                    break
-                events = device.read()
-                for event in events:
-                    if self.stop_event.is_set():
-                        break
-                    etype = event.type
-                    ecode = event.code
-                    evalue = event.value
-                    if etype == 1 and ecode == 2:
-                        if evalue == 1:
-                            # self.logger.info('Key1 pressed (key)')
-                            key_used = 'key_PRESS'
-                        else:
-                            # self.logger.info('Key1 released (key)')
-                            key_used = 'key_RELEASE'
-                    elif etype == 1 and ecode == 3:
-                        if evalue == 1:
-                            # self.logger.info('Key2 pressed (star)')
-                            key_used = 'star_PRESS'
-                        else:
-                            # self.logger.info('Key2 released (star)')
-                            key_used = 'star_RELEASE'
-                    elif etype == 1 and ecode == 4:
-                        if evalue == 1:
-                            # self.logger.info('Key3 pressed (eye)')
-                            key_used = 'eye_PRESS'
-                        else:
-                            # self.logger.info('Key3 released (eye)')
-                            key_used = 'eye_RELEASE'
-                    elif etype == 1 and ecode == 5:
-                        if evalue == 1:
-                            # self.logger.info('Key4 pressed (phone)')
-                            key_used = 'phone_PRESS'
-                        else:
-                            # self.logger.info('Key4 released (phone)')
-                            key_used = 'phone_RELEASE'
-                    # else:
-                        # self.logger.info('Event: ' + str(event))
-                        # self.logger.info('Event type: ' + str(etype))
-                        # self.logger.info('Event code: ' + str(ecode))
-                        # self.logger.info('Event value: ' + str(evalue))
-                        # print(event)
-                        # print(evdev.categorize(event))
-            if key_used:
-                topic = 'video_intercom/keypad/state'
-                message = json.dumps({"event_type": key_used})
-                client.publish(topic, message)
-                self.logger.info('Sent key: ' + topic + ' ' + message)
-            time.sleep(0.1)
-            if self.stop_event.is_set():
-                break
-        self.logger.info('Thread keydetection finished')
+# evdev key code of /dev/input/event0 -> keypad event name
+KEYS = {
+    2: 'key',
+    3: 'star',
+    4: 'eye',
+    5: 'phone',
+}
+
+# TCP ports of the device's own traffic, skipped like the tcpdump filter of
+# mqtt_scripts/StartMqttSend: source ports and destination ports
+EXCLUDED_SRC_PORTS = (5007, 5060, 20000)
+EXCLUDED_DST_PORTS = (5007, 5060, 20000, 30006)
+
+SO_ATTACH_FILTER = 26
+
+# PACKET_MMAP (TPACKET_V3) capture ring of the raw socket
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+TP_STATUS_LOSING = 4
+# a block holds at least one 64 KiB lo segment
+RING_BLOCK_SIZE = 1 << 17
+RING_BLOCK_NR = 16
+RING_FRAME_SIZE = 2048
+RING_RETIRE_MS = 8
+# seconds between reads of the ring packet and drop counters
+RING_STATS_INTERVAL = 60
+# tpacket_block_desc: block_status, num_pkts, offset_to_first_pkt
+BLOCK_HDR = struct.Struct('=III')
+BLOCK_HDR_OFFSET = 8
+# tpacket3_hdr: tp_next_offset, tp_snaplen, tp_mac
+PACKET_HDR = struct.Struct('=I8xI8xH')
+# frames looked for in the TCP payload of the raw socket packets, first
+# match wins; searched in place, the ring packets are not copied
+PACKET_TRIGGERS = (
+    (re.compile(re.escape(b'*8*1#1#4#21*16##')), 'DOORBELL', 'doorbell'),
+    (re.compile(re.escape(b'*8*19*20##')), 'PRESS', 'press'),
+    (re.compile(re.escape(b'*8*20*20##')), 'RELEASE', 'release'),
+)
+ACCEPT = 'accept'
+DROP = 'drop'
+
+
+def raw_socket_filter():
+    """Classic BPF program: TCP segments with payload, excluded ports out.
+
+    Every segment crosses lo twice (outgoing and incoming), only the
+    incoming copy is kept. Offsets are those of parse_packet(): 14 bytes
+    of (loopback) Ethernet header, then the IPv4 header of length X.
+    """
+    prog = [
+        (0x20, 0, 0, 0xfffff004),   # ld pkttype
+        (0x15, DROP, 0, 4),         # outgoing copy: lo also shows it incoming
+        (0x28, 0, 0, 12),           # ldh [12]: ethertype
+        (0x15, 0, DROP, 0x0800),    # IPv4
+        (0x30, 0, 0, 23),           # ldb [23]: IP protocol
+        (0x15, 0, DROP, 6),         # TCP
+        (0x28, 0, 0, 20),           # ldh [20]: fragment offset
+        (0x45, DROP, 0, 0x1fff),    # first fragment only
+        (0xb1, 0, 0, 14),           # ldxb 4*([14]&0xf): IP header length
+        (0x48, 0, 0, 14),           # ldh [x+14]: source port
+    ]
+    prog += [(0x15, DROP, 0, port) for port in EXCLUDED_SRC_PORTS]
+    prog.append((0x48, 0, 0, 16))  # ldh [x+16]: destination port
+    prog += [(0x15, DROP, 0, port) for port in EXCLUDED_DST_PORTS]
+    prog += [
+        (0x50, 0, 0, 26),           # ldb [x+26]: TCP data offset
+        (0x54, 0, 0, 0xf0),         # and #0xf0
+        (0x74, 0, 0, 2),            # rsh #2: TCP header length
+        (0x0c, 0, 0, 0),            # add x: IP + TCP header length
+        (0x02, 0, 0, 0),            # st M[0]
+        (0x28, 0, 0, 16),           # ldh [16]: IP total length
+        (0x61, 0, 0, 0),            # ldx M[0]
+        (0x2d, ACCEPT, DROP, 0),    # jgt x: some payload left
+        (0x06, 0, 0, 0xffff),       # accept: ret #65535
+        (0x06, 0, 0, 0),            # drop: ret #0
+    ]
+    target = {ACCEPT: len(prog) - 2, DROP: len(prog) - 1}
+    code = b''
+    for i, (op, jt, jf, k) in enumerate(prog):
+        jt = target[jt] - i - 1 if jt in target else jt
+        jf = target[jf] - i - 1 if jf in target else jf
+        code += struct.pack('=HBBI', op, jt, jf, k)
+    return len(prog), code
 
 
 class Control:
@@ -190,8 +168,19 @@ class Control:
         """Start the class."""
         # vars
         self.stop_event = threading.Event()
-        self.child_thread = None
         self.stop_main_thread = False
+        self.selector = None
+        self.wakeup = None
+        self.keys_device = None
+        self.notifier = None
+        self.capture = None
+        self.ring = None
+        self.ring_view = None
+        self.ring_block = 0
+        self.ring_stats_at = 0
+        self.rs_packets = 0
+        self.rs_drops = 0
+        self.last_rcmd = None
         # self.detect_execution()
         self.setuplogging()
         self.create_vars()
@@ -199,6 +188,7 @@ class Control:
         self.normal_execution()
         self.mls = None
         self.rs = None
+        self.rs_filter = None
         self.model = None
         self.logging_level = None
         self.localfolder = None
@@ -281,11 +271,25 @@ class Control:
     def setupkeydetection(self):
         """Setup key detection."""
         from evdev import InputDevice
-        from selectors import DefaultSelector, EVENT_READ
-        selector = DefaultSelector()
-        gpios = InputDevice('/dev/input/event0')
-        selector.register(gpios, EVENT_READ)
-        return selector
+        return InputDevice('/dev/input/event0')
+
+    def setupgpioledsdetection(self, client):
+        """Setup GPIO and LEDs detection, None if nothing to watch."""
+        led_symlink_pattern = '/sys/class/leds/*/brightness'
+        gpio_file_pattern = '/sys/class/gpio/*/value'
+        # Initialize an inotify watcher
+        wm = pyinotify.WatchManager()
+        # Define the events you want to watch for (symbolic link modification)
+        mask = pyinotify.IN_MODIFY
+        paths = glob.glob(led_symlink_pattern) + glob.glob(gpio_file_pattern)
+        if not paths:
+            return None
+        for path in paths:
+            wm.add_watch(path, mask)
+        # events are read when the selector reports the inotify fd
+        self.notifier = pyinotify.Notifier(
+            wm, EventHandler(self.logger, client), timeout=0)
+        return wm
 
     def multicast_listener(self):
         """Multicast listener."""
@@ -304,7 +308,7 @@ class Control:
             socket.inet_aton(multicast_group) + socket.inet_aton("0.0.0.0"))
 
         # Set up event handling
-        self.mls.settimeout(1.0)
+        self.mls.setblocking(False)
         self.logger.info("Multicast listener socket created")
 
     def rawsocket(self):
@@ -313,10 +317,64 @@ class Control:
         self.rs = socket.socket(
             socket.AF_PACKET,
             socket.SOCK_RAW, socket.ntohs(0x0003))
+        # Only the loopback traffic, filtered in the kernel
+        self.rs.bind(('lo', 0))
+        length, code = raw_socket_filter()
+        self.rs_filter = ctypes.create_string_buffer(code)
+        fprog = struct.pack('HP', length, ctypes.addressof(self.rs_filter))
+        self.rs.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
         # Set up event handling
-        self.rs.settimeout(1.0)
+        self.rs.setblocking(False)
+        # Drop what was queued before the filter was attached
+        try:
+            while True:
+                self.rs.recv(65535)
+        except BlockingIOError:
+            pass
+        if self.capture == 'ring':
+            self.packet_ring()
         self.logger.info("Raw socket created")
 
+    def packet_ring(self):
+        """Receive the raw socket packets in a TPACKET_V3 mmap ring."""
+        self.rs.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+        req = struct.pack(
+            '=7I', RING_BLOCK_SIZE, RING_BLOCK_NR, RING_FRAME_SIZE,
+            RING_BLOCK_SIZE * RING_BLOCK_NR // RING_FRAME_SIZE,
+            RING_RETIRE_MS, 0, 0)
+        self.rs.setsockopt(SOL_PACKET, PACKET_RX_RING, req)
+        self.ring = mmap.mmap(self.rs.fileno(),
+                              RING_BLOCK_SIZE * RING_BLOCK_NR,
+                              mmap.MAP_SHARED,
+                              mmap.PROT_READ | mmap.PROT_WRITE)
+        self.ring_view = memoryview(self.ring)
+        self.ring_block = 0
+        self.ring_stats_at = time.monotonic()
+        self.logger.info("Packet ring of %d blocks of %d bytes",
+                         RING_BLOCK_NR, RING_BLOCK_SIZE)
+
+    def close_rawsocket(self):
+        """Close the raw socket and its ring."""
+        if self.ring:
+            self.ring_statistics()
+            self.ring_view.release()
+            self.ring.close()
+            self.ring = None
+            self.logger.info("Raw socket ring: %d packets, %d dropped",
+                             self.rs_packets, self.rs_drops)
+        self.rs.close()
+
+    def ring_statistics(self):
+        """Add the kernel packet and drop counters (reset on read)."""
+        packets, drops, _ = struct.unpack(
+            '=III', self.rs.getsockopt(SOL_PACKET, PACKET_STATISTICS, 12))
+        self.ring_stats_at = time.monotonic()
+        self.rs_packets += packets
+        self.rs_drops += drops
+        if drops:
+            self.logger.warning("Raw socket ring dropped %d packets"
+                                " (%d in total)", drops, self.rs_drops)
+
     def parse_packet2(self, packet):
         """Parse packet."""
         result = None
@@ -393,15 +451,8 @@ class Control:
     def parse_packet(self, packet):
         """Parse packet."""
         result = None
-        doorbell = '*8*1#1#4#21*16##'
-        bin_doorbell = doorbell.encode().hex()
-        open_press = '*8*19*20##'
-        bin_open_press = open_press.encode().hex()
-        open_release = '*8*20*20##'
-        bin_open_release = open_release.encode().hex()
         # Extract packet data and source address
         p_data, address = packet
-        pdathx = p_data.hex()
 
         # Check if it's a TCP packet
         if p_data[23] == 6:  # 6 corresponds to TCP in IP header
@@ -413,33 +464,20 @@ class Control:
                 org_port = (p_data[34] << 8) + p_data[35]
 
                 # Check if it's not one of the excluded ports
-                aports = {5007, 5060, 20000, 30006}
-                bports = {5007, 5060, 20000}
-                if dst_port not in aports and org_port not in bports:
-                    # Print the packet data (hexadecimal representation)
-                    if bin_doorbell in pdathx:
-                        self.logger.debug(
-                            "Packet doorbell from %s: %s"
-                            " Puerto de origen: %s"
-                            " Puerto de destino: %s",
-                            address, pdathx, org_port, dst_port)
-                        result = 'DOORBELL'
-                    elif bin_open_press in pdathx:
-                        self.logger.debug(
-                            "Packet press from %s: %s"
-                            " Puerto de origen: %s"
-                            " Puerto de destino: %s",
-                            address, pdathx, org_port, dst_port)
-                        result = 'PRESS'
-                    elif bin_open_release in pdathx:
-                        self.logger.debug(
-                            "Packet release from %s: %s"
-                            " Puerto de origen: %s"
-                            " Puerto de destino: %s",
-                            address, pdathx, org_port, dst_port)
-                        result = 'RELEASE'
-                    else:
-                        pass
+                if (dst_port not in EXCLUDED_DST_PORTS
+                        and org_port not in EXCLUDED_SRC_PORTS):
+                    # TCP payload starts after the data offset of the header
+                    payload = 34 + (p_data[46] >> 4) * 4
+                    for pattern, trigger, name in PACKET_TRIGGERS:
+                        if pattern.search(p_data, payload):
+                            # Print the packet data (hexadecimal representation)
+                            self.logger.debug(
+                                "Packet %s from %s: %s"
+                                " Puerto de origen: %s"
+                                " Puerto de destino: %s",
+                                name, address, p_data.hex(), org_port, dst_port)
+                            result = trigger
+                            break
         return result
 
     def check_certs_exist(self):
@@ -459,10 +497,11 @@ class Control:
         """Signal handler."""
         # def handler(signum, frame):
         self.logger.info('Signal handler called with signal %s', signum)
-        if self.child_thread:
-            self.child_thread.stop()
         self.stop_main_thread = True
         self.stop_event.set()
+        # wake up the selector
+        if self.wakeup:
+            self.wakeup[1].send(b'\0')
         # return handler
 
     def normal_execution(self):
@@ -518,130 +557,208 @@ class Control:
         # Set config keypad (trigger)
         (t, m) = self.sent_mqtt_config_keypad(jsondata)
         client.publish(t, m, retain=True)
+        # MQTT network loop in its own thread
+        client.loop_start()
         # Init multicast listener
         self.multicast_listener()
         # Init raw socket
         self.rawsocket()
 
-        selector = self.setupkeydetection()
-        # Create new thread for key detection
-        # self.child_thread = threading.Thread(
-        #    target=self.keydetection, args=(selector, client))
-        self.child_thread = KeyDetectionThread(
-            self.logger, selector, client, self.stop_event)
-        # self.child_thread.run(selector, client)
-        self.child_thread.start()
+        # One selector for every source: each one is handled as soon as
+        # its fd is readable, and select() sleeps until then
+        self.selector = selectors.DefaultSelector()
+        self.wakeup = socket.socketpair()
+        self.wakeup[0].setblocking(False)
+        self.selector.register(self.wakeup[0], selectors.EVENT_READ, None)
+        self.selector.register(self.mls, selectors.EVENT_READ,
+                               self.handle_multicast)
+        if self.ring:
+            self.selector.register(self.rs, selectors.EVENT_READ,
+                                   self.handle_ring)
+        else:
+            self.selector.register(self.rs, selectors.EVENT_READ,
+                                   self.handle_rawsocket)
+        # Key detection
+        self.keys_device = self.setupkeydetection()
+        self.selector.register(self.keys_device, selectors.EVENT_READ,
+                               self.handle_keys)
         # GPIO and LEDs
-        self.child_thread_2 = GPIOLEDsDetectionThread(
-            self.logger, client, self.stop_event)
-        self.child_thread_2.start()
+        wm = self.setupgpioledsdetection(client)
+        if wm:
+            self.selector.register(wm.get_fd(), selectors.EVENT_READ,
+                                   self.handle_gpioleds)
+
+        while not self.stop_main_thread:
+            try:
+                events = self.selector.select()
+            except KeyboardInterrupt:
+                self.logger.info('Salida debido a CTRL+C')
+                break
+            for key, mask in events:
+                if key.data:
+                    key.data(client)
+                else:
+                    # signal wake up
+                    try:
+                        self.wakeup[0].recv(64)
+                    except BlockingIOError:
+                        pass
 
-        r_cmd = None
-        last_rcmd = None
+        # End while
+        self.logger.info('Normal exit')
+        self.selector.close()
+        if self.notifier:
+            self.notifier.stop()
+        self.keys_device.close()
+        client.disconnect()
+        client.loop_stop()
+        self.mls.close()
+        self.close_rawsocket()
+        for sock in self.wakeup:
+            sock.close()
+
+    def handle_multicast(self, client):
+        """Read every datagram waiting on the multicast listener socket."""
         while True:
-            # multicast listener socket
             try:
                 # Adjust the buffer size as needed
                 data, addr = self.mls.recvfrom(1024)
-                # data
-                r_cmd = self.parse_packet2(data)
-                if r_cmd:
-                    if r_cmd == last_rcmd:
-                        pass
-                    else:
-                        msg_data = self.parse_cmd(r_cmd)
-                        if msg_data:
-                            self.logger.info(
-                                "Received (mls): %s "
-                                "from %s", msg_data, str(addr))
-                            if msg_data == 'display ON':
-                                topic = 'video_intercom/display/state'
-                                message = json.dumps({"display": "ON"})
-                                client.publish(topic, message)
-                            elif msg_data == 'display OFF':
-                                topic = 'video_intercom/display/state'
-                                message = json.dumps({"display": "OFF"})
-                                client.publish(topic, message)
-                            elif 'voicemail ON' in msg_data:
-                                topic = 'video_intercom/voicemail/state'
-                                message = "ON"
-                                client.publish(topic, message)
-                            elif 'voicemail OFF' in msg_data:
-                                topic = 'video_intercom/voicemail/state'
-                                message = "OFF"
-                                client.publish(topic, message)
-                            elif msg_data == 'bell ON':
-                                topic = 'video_intercom/doorbellsound/state'
-                                message = "ON"
-                                client.publish(topic, message)
-                            elif msg_data == 'bell OFF':
-                                topic = 'video_intercom/doorbellsound/state'
-                                message = "OFF"
-                                client.publish(topic, message)
-                            else:
-                                pass
-                        else:
-                            self.logger.info(
-                                "Received (mls): %s"
-                                " from %s", r_cmd, str(addr))
-            except socket.timeout:
-                pass
+            except BlockingIOError:
+                return
             except socket.error as e:
                 self.logger.error("Error message (mls): %s", str(e))
-            last_rcmd = r_cmd
+                return
+            r_cmd = self.parse_packet2(data)
+            if r_cmd and r_cmd != self.last_rcmd:
+                self.publish_cmd(client, r_cmd, addr)
+            self.last_rcmd = r_cmd
+
+    def publish_cmd(self, client, r_cmd, addr):
+        """Publish the state change of a multicast command."""
+        msg_data = self.parse_cmd(r_cmd)
+        if msg_data:
+            self.logger.info(
+                "Received (mls): %s "
+                "from %s", msg_data, str(addr))
+            if msg_data == 'display ON':
+                topic = 'video_intercom/display/state'
+                message = json.dumps({"display": "ON"})
+                client.publish(topic, message)
+            elif msg_data == 'display OFF':
+                topic = 'video_intercom/display/state'
+                message = json.dumps({"display": "OFF"})
+                client.publish(topic, message)
+            elif 'voicemail ON' in msg_data:
+                topic = 'video_intercom/voicemail/state'
+                message = "ON"
+                client.publish(topic, message)
+            elif 'voicemail OFF' in msg_data:
+                topic = 'video_intercom/voicemail/state'
+                message = "OFF"
+                client.publish(topic, message)
+            elif msg_data == 'bell ON':
+                topic = 'video_intercom/doorbellsound/state'
+                message = "ON"
+                client.publish(topic, message)
+            elif msg_data == 'bell OFF':
+                topic = 'video_intercom/doorbellsound/state'
+                message = "OFF"
+                client.publish(topic, message)
+            else:
+                pass
+        else:
+            self.logger.info(
+                "Received (mls): %s"
+                " from %s", r_cmd, str(addr))
 
-            # raw socket
+    def handle_rawsocket(self, client):
+        """Read every packet waiting on the raw socket."""
+        while True:
             try:
                 # Adjust the buffer size as needed
                 packet = self.rs.recvfrom(65535)
-                # packet trigger
-                trigger = self.parse_packet(packet)
-                if trigger:
-                    self.logger.info("Received (rs): %s", trigger)
-                    if trigger == 'DOORBELL':
-                        topic = 'video_intercom/doorbell/state'
-                        message = trigger
-                        client.publish(topic, message)
-                    elif trigger == 'PRESS':
-                        topic = 'video_intercom/lock/state'
-                        message = 'UNLOCKING'
-                        client.publish(topic, message)
-                        time.sleep(1)
-                        message = 'UNLOCKED'
-                        client.publish(topic, message)
-                    elif trigger == 'RELEASE':
-                        topic = 'video_intercom/lock/state'
-                        message = 'LOCKING'
-                        client.publish(topic, message)
-                        time.sleep(1)
-                        message = 'LOCKED'
-                        client.publish(topic, message)
-                    else:
-                        pass
-            except socket.timeout:
-                pass
+            except BlockingIOError:
+                return
             except socket.error as e:
                 self.logger.error("Error message (rs): %s", str(e))
-
-            try:
-                client.loop_start()
-            except KeyboardInterrupt:
-                client.loop_stop()
-                self.logger.info('Salida debido a CTRL+C')
-                break
-            if self.stop_main_thread:
+                return
+            # packet trigger
+            trigger = self.parse_packet(packet)
+            if trigger:
+                self.publish_trigger(client, trigger)
+
+    def handle_ring(self, client):
+        """Walk the blocks the kernel handed over, packets parsed in place."""
+        view = self.ring_view
+        losing = False
+        while True:
+            base = self.ring_block * RING_BLOCK_SIZE
+            status, num_pkts, offset = BLOCK_HDR.unpack_from(
+                view, base + BLOCK_HDR_OFFSET)
+            if not status & TP_STATUS_USER:
                 break
-            time.sleep(0.1)
+            losing |= bool(status & TP_STATUS_LOSING)
+            pkt = base + offset
+            for _ in range(num_pkts):
+                next_offset, snaplen, mac = PACKET_HDR.unpack_from(view, pkt)
+                data = view[pkt + mac:pkt + mac + snaplen]
+                trigger = self.parse_packet((data, 'lo'))
+                data.release()
+                if trigger:
+                    self.publish_trigger(client, trigger)
+                pkt += next_offset
+            # give the block back to the kernel
+            struct.pack_into('=I', view, base + BLOCK_HDR_OFFSET,
+                             TP_STATUS_KERNEL)
+            self.ring_block = (self.ring_block + 1) % RING_BLOCK_NR
+        if (losing or time.monotonic() - self.ring_stats_at
+                >= RING_STATS_INTERVAL):
+            self.ring_statistics()
+
+    def publish_trigger(self, client, trigger):
+        """Publish a doorbell or lock trigger."""
+        self.logger.info("Received (rs): %s", trigger)
+        if trigger == 'DOORBELL':
+            topic = 'video_intercom/doorbell/state'
+            message = trigger
+            client.publish(topic, message)
+        elif trigger == 'PRESS':
+            topic = 'video_intercom/lock/state'
+            message = 'UNLOCKING'
+            client.publish(topic, message)
+            # second state 1 s later, without holding up the loop
+            threading.Timer(1, client.publish, (topic, 'UNLOCKED')).start()
+        elif trigger == 'RELEASE':
+            topic = 'video_intercom/lock/state'
+            message = 'LOCKING'
+            client.publish(topic, message)
+            threading.Timer(1, client.publish, (topic, 'LOCKED')).start()
+        else:
+            pass
 
-        # End while
-        self.logger.info('Normal exit')
-        # Wait for child thread to terminate
-        if self.child_thread:
-            self.child_thread.join()
-        client.disconnect()
-        client.loop_stop()
-        self.mls.close()
-        self.rs.close()
+    def handle_keys(self, client):
+        """Read the pending key events of /dev/input/event0."""
+        key_used = None
+        try:
+            for event in self.keys_device.read():
+                # etype 1 = key, value 1 = pressed
+                if event.type == 1 and event.code in KEYS:
+                    if event.value == 1:
+                        key_used = KEYS[event.code] + '_PRESS'
+                    else:
+                        key_used = KEYS[event.code] + '_RELEASE'
+        except BlockingIOError:
+            pass
+        if key_used:
+            topic = 'video_intercom/keypad/state'
+            message = json.dumps({"event_type": key_used})
+            client.publish(topic, message)
+            self.logger.info('Sent key: ' + topic + ' ' + message)
+
+    def handle_gpioleds(self, client):
+        """Process the pending inotify events of GPIOs and LEDs."""
+        self.notifier.read_events()
+        self.notifier.process_events()
 
     def sent_mqtt_config_lock(self, jsondata):
         """Sent mqtt config lock."""
@@ -1046,6 +1163,8 @@ class Control:
         abs_file_path = os.path.join(script_dir, rel_path)
         config.read(abs_file_path)
         self.logging_level = config['DEFAULT']['logging_level']
+        # capture = socket (recvfrom) or ring (PACKET_MMAP)
+        self.capture = config['DEFAULT'].get('capture', 'socket')
         self.localfolder = config['DEFAULT']['localfolder']
         self.enable_tls = config['MQTT']['enableTLS']
         self.host_mqtt = config['MQTT']['host']